@@ -0,0 +1,267 @@
+"""
+End-to-end benchmark of the scanner and of the reference hashing, on a
+labelled synthetic corpus generated offline (seeded, so reproducible):
+reference-style card images, and photos of them (perspective, rotation,
+blur, noise, exposure) pasted onto textured backgrounds.
+
+Measures the per-stage latency (decode, preprocess, segment, hash, match),
+throughput, peak memory and top-1 accuracy of 'Scanner.scan', and the
+hashing throughput of 'save'. Results are written as json, so that they
+can be compared from one commit to the next.
+
+Run from 'src': python -m benchmarks.e2e [-o e2e.json] [--compare previous.json]
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import resource
+import subprocess
+import time
+import tracemalloc
+
+import numpy as np
+import cv2 as cv
+
+from inputimage import InputImage
+from phashindex import PHashIndex
+from preprocessor import PreProcessor
+from referenceimage import ReferenceImage
+from save import compute_ref_phash
+from scanner import Scanner
+from utils import imdecode_reduced
+
+
+STAGES = ('decode', 'preprocess', 'segment', 'hash', 'match')
+
+
+def reference_card(rng, height=680, width=488):
+    """
+    Reference-style card image (the size of Scryfall 'normal' images): black
+    border, coloured frame, title and type bars, art box and text box.
+    """
+    frame_color = rng.integers(40, 220, 3)
+    card = np.zeros((height, width, 3), np.uint8)
+    cv.rectangle(card, (18, 18), (width - 19, height - 19), frame_color.tolist(), -1)
+    # Art: smooth colour field and a few shapes
+    art = cv.resize(rng.integers(0, 256, (int(rng.integers(3, 8)), int(rng.integers(3, 8)), 3), dtype=np.uint8),
+                    (width - 80, 290), interpolation=cv.INTER_CUBIC)
+    for _ in range(int(rng.integers(2, 6))):
+        center = (int(rng.integers(0, width - 80)), int(rng.integers(0, 290)))
+        cv.circle(art, center, int(rng.integers(10, 80)), rng.integers(0, 256, 3).tolist(), -1)
+    card[80:370, 40:width - 40] = art
+    # Title, type line and text box, with words as dark bars
+    for (y0, y1) in ((34, 70), (380, 416)):
+        cv.rectangle(card, (34, y0), (width - 35, y1), (frame_color // 2 + 100).tolist(), -1)
+        cv.rectangle(card, (46, y0 + 12), (int(rng.integers(150, width - 120)), y1 - 12), (20, 20, 20), -1)
+    cv.rectangle(card, (40, 426), (width - 41, height - 60), (225, 225, 215), -1)
+    for y in range(442, height - 80, 22):
+        x = 54
+        while x < width - 110:
+            word = int(rng.integers(15, 70))
+            cv.rectangle(card, (x, y), (x + word, y + 8), (30, 30, 30), -1)
+            x += word + 10
+    return card
+
+
+def card_photo(rng, card, height=1200, width=900):
+    """
+    Photo of a card: perspective and rotation, pasted onto a textured background, then blurred, exposed and noised.
+    """
+    background = cv.resize(rng.integers(90, 256, (9, 7, 3), dtype=np.uint8), (width, height), interpolation=cv.INTER_CUBIC)
+    background = cv.add(background, rng.integers(0, 25, (height, width, 3), dtype=np.uint8))
+    card_height = rng.uniform(0.55, 0.8) * height
+    card_width = card_height * card.shape[1] / card.shape[0]
+    center = np.array([width, height]) / 2 + rng.uniform(-0.08, 0.08, 2) * (width, height)
+    corners = np.array([[-1, -1], [1, -1], [1, 1], [-1, 1]]) * (card_width / 2, card_height / 2)
+    angle = np.radians(rng.uniform(-12, 12))
+    rotation = np.array([[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]])
+    corners = corners @ rotation.T + center + rng.uniform(-0.02, 0.02, (4, 2)) * card_height
+    source = np.float32([[0, 0], [card.shape[1], 0], [card.shape[1], card.shape[0]], [0, card.shape[0]]])
+    M = cv.getPerspectiveTransform(source, np.float32(corners))
+    warped = cv.warpPerspective(card, M, (width, height))
+    mask = cv.warpPerspective(np.full(card.shape[:2], 255, np.uint8), M, (width, height))
+    photo = np.where(mask[:, :, None] > 127, warped, background)
+    photo = cv.GaussianBlur(photo, (0, 0), rng.uniform(0.5, 2.))
+    photo = cv.convertScaleAbs(photo * rng.uniform(0.75, 1.2, 3).astype(np.float32), beta=rng.uniform(-20, 20))
+    noise = cv.randn(np.empty(photo.shape, np.float32), 0, 4)  # OpenCV's generator, seeded by make_corpus
+    return cv.add(photo, noise, dtype=cv.CV_8U)
+
+
+def make_corpus(reference_count, photo_count, seed):
+    """
+    Returns the encoded reference images, and the encoded photos with the index of the reference they show.
+    """
+    rng = np.random.default_rng(seed)
+    cv.setRNGSeed(seed)
+    cards = [reference_card(rng) for _ in range(reference_count)]
+    references = [cv.imencode('.jpg', card, (cv.IMWRITE_JPEG_QUALITY, 90))[1].tobytes() for card in cards]
+    labels = rng.integers(0, reference_count, photo_count)
+    photos = [cv.imencode('.jpg', card_photo(rng, cards[label]), (cv.IMWRITE_JPEG_QUALITY, 90))[1].tobytes()
+              for label in labels]
+    return references, photos, labels
+
+
+def latency_stats(seconds):
+    """
+    Mean and percentiles of latency samples, in ms.
+    """
+    ms = np.asarray(seconds) * 1000
+    return {'mean': round(float(np.mean(ms)), 4), 'p50': round(float(np.percentile(ms, 50)), 4),
+            'p95': round(float(np.percentile(ms, 95)), 4), 'max': round(float(np.max(ms)), 4)}
+
+
+def bench_save(references):
+    """
+    Hashes the reference images as 'save' does (decode + hash). Returns the json references and the results.
+    """
+    start_time = time.perf_counter()
+    phashes = [compute_ref_phash(content) for content in references]
+    elapsed = time.perf_counter() - start_time
+    ref_images = [ReferenceImage(str(i), phash).toJSON() for i, phash in enumerate(phashes)]
+    return ref_images, {'images': len(references), 'images_per_s': round(len(references) / elapsed, 2),
+                        'latency_ms': latency_stats([elapsed / len(references)])['mean']}
+
+
+def scan_stages(scanner, photo):
+    """
+    Scans an encoded photo the way 'Scanner.scan' does, timing each stage. Returns (id or None, stage seconds).
+    """
+    times = {}
+    lap_time = time.perf_counter()
+
+    def lap(stage):
+        nonlocal lap_time
+        now = time.perf_counter()
+        times[stage] = now - lap_time
+        lap_time = now
+
+    image = imdecode_reduced(photo, PreProcessor.max_size)
+    lap('decode')
+    input_img_obj = InputImage(image)
+    scanner.pp.pre_process_image(input_img_obj, scanner.clahe)
+    lap('preprocess')
+    try:
+        scanner.seg.segment(input_img_obj)
+    except ValueError:
+        return None, times
+    lap('segment')
+    if input_img_obj.card_image.size == 0:
+        return None, times
+    phash = scanner.computes_phash(input_img_obj.card_image)
+    lap('hash')
+    id = scanner.compare_phash(phash)
+    lap('match')
+    return id, times
+
+
+def bench_scan(scanner, photos, labels, workers):
+    """
+    Stage latencies, accuracy and peak memory of sequential scans, then throughput of 'scan_batch'.
+    """
+    samples = {stage: [] for stage in STAGES}
+    totals = []
+    correct, failed = 0, 0
+    start_time = time.perf_counter()
+    for photo, label in zip(photos, labels):
+        id, times = scan_stages(scanner, photo)
+        for stage, seconds in times.items():
+            samples[stage].append(seconds)
+        totals.append(sum(times.values()))
+        failed += id is None
+        correct += id == str(label)
+    elapsed = time.perf_counter() - start_time
+
+    # Peak Python heap (numpy buffers included), in a separate pass since tracing slows allocations down
+    tracemalloc.start()
+    for photo in photos[:min(len(photos), 50)]:
+        scan_stages(scanner, photo)
+    peak_bytes = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    start_time = time.perf_counter()
+    batch_ids = list(scanner.scan_batch(photos, workers))
+    batch_elapsed = time.perf_counter() - start_time
+
+    return {'images': len(photos),
+            'top1_accuracy': round(correct / len(photos), 4),
+            'failed': failed,
+            'latency_ms': {'total': latency_stats(totals),
+                           **{stage: latency_stats(samples[stage]) for stage in STAGES if samples[stage]}},
+            'images_per_s': round(len(photos) / elapsed, 2),
+            'batch': {'workers': workers, 'images_per_s': round(len(photos) / batch_elapsed, 2),
+                      'top1_accuracy': round(float(np.mean([id == str(label) for id, label in zip(batch_ids, labels)])), 4)},
+            'peak_traced_kb': round(peak_bytes / 1024, 1)}
+
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {'commit': commit, 'date': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+            'python': platform.python_version(), 'numpy': np.__version__, 'opencv': cv.__version__,
+            'machine': platform.machine(), 'cpus': os.cpu_count()}
+
+
+def flatten(results, prefix=''):
+    """
+    Numeric results by dotted key, for comparisons.
+    """
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, prefix + key + '.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[prefix + key] = value
+    return flat
+
+
+def compare(previous, current):
+    """
+    Prints the metrics of two result files side by side, with their ratio.
+    """
+    previous_flat, current_flat = flatten(previous['results']), flatten(current['results'])
+    print(f"{'metric':<40} {previous['environment'].get('commit') or 'previous':>12} {current['environment'].get('commit') or 'current':>12}   ratio")
+    for key, value in current_flat.items():
+        if key in previous_flat:
+            ratio = value / previous_flat[key] if previous_flat[key] else float('nan')
+            print(f"{key:<40} {previous_flat[key]:>12} {value:>12}   x{ratio:.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-r', '--references', default=500, type=int, help='number of reference cards')
+    parser.add_argument('-n', '--photos', default=200, type=int, help='number of card photos to scan')
+    parser.add_argument('-s', '--seed', default=0, type=int, help='corpus seed')
+    parser.add_argument('-w', '--workers', default=os.cpu_count() or 1, type=int, help='number of processes of the batch scan')
+    parser.add_argument('-o', '--output', default='e2e.json', help='json results file')
+    parser.add_argument('-c', '--compare', default=None, help='previous json results file to compare with')
+    args = parser.parse_args()
+
+    start_time = time.perf_counter()
+    references, photos, labels = make_corpus(args.references, args.photos, args.seed)
+    print(f"Generated {len(references)} references and {len(photos)} photos in {round(time.perf_counter() - start_time, 2)} s")
+
+    ref_images, save_results = bench_save(references)
+    scanner = Scanner(index=PHashIndex.from_references(ref_images))
+    scan_results = bench_scan(scanner, photos, labels, args.workers)
+
+    output = {'environment': environment(),
+              'corpus': {'references': args.references, 'photos': args.photos, 'seed': args.seed},
+              'results': {'save': save_results, 'scan': scan_results,
+                          'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}}
+    with open(args.output, 'w', encoding='utf-8') as file:
+        json.dump(output, file, indent=2)
+    print(json.dumps(output['results'], indent=2))
+    print(f"Wrote {args.output}")
+
+    if args.compare is not None:
+        with open(args.compare, encoding='utf-8') as file:
+            compare(json.load(file), output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+"""
+Benchmark of multi-index hashing against a brute-force popcount scan, on
+1024-bit hashes (32x32 pHashes) at several catalogue sizes.
+
+References are random packed hashes (seeded). Queries are references with
+a given number of random bits flipped, so that their nearest reference is
+at a known distance, and random hashes (nothing close). For each size and
+distance, measures the latency of an exact top-2 search by brute force,
+and by 'MultiIndex.search' (and whether it proved the result), then of a
+near duplicate match: 'PHashIndex.match' bounded by the distance the
+tables prove ('MultiIndex.max_distance', 31 bits at radius 1), with the
+tables (multi-index hashing) and without (coarse/fine search).
+Every proven result is checked against brute force, and so is every
+match: exactly with the tables, and without, its margin never below the
+true one when it found the nearest reference.
+
+Run from 'src': python -m benchmarks.mih [-n 50000 200000 1000000] [-o mih.json]
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+
+from multiindex import MultiIndex
+from phashindex import PHashIndex
+
+
+HASH_BITS = 1024
+DISTANCES = (0, 8, 16, 31, 48, 96, 300)
+
+
+def flip_bits(rng, hash, count):
+    bits = np.unpackbits(hash.view(np.uint8))
+    bits[rng.choice(bits.size, count, replace=False)] ^= 1
+    return np.packbits(bits).view(np.uint64)
+
+
+def brute_force(hashes, query):
+    """
+    Rows and distances of the two references closest to the query, by a full popcount pass.
+    """
+    distances = np.bitwise_count(hashes ^ query).sum(axis=1, dtype=np.uint32)
+    rows = np.argpartition(distances, 1)[:2]
+    rows = rows[np.argsort(distances[rows], kind='stable')]
+    return rows, distances[rows]
+
+
+def check_match(match, rows, distances, limit, exact):
+    """
+    Checks an (id, distance, margin) match against the brute force top-2. With 'exact', the distance and the margin must be the
+    true ones, else the distance may only be overestimated, and the margin of the true nearest reference too (runner-up not shortlisted).
+    """
+    id, distance, margin = match
+    true_margin = int(min(distances[1], limit + 1) - distances[0])
+    if exact and (distance != distances[0] or margin != true_margin):
+        raise AssertionError("Match differs from brute force", match, distances.tolist())
+    if not exact and (distance < distances[0] or (distance == distances[0] and margin < true_margin)):
+        raise AssertionError("Match is closer than brute force", match, distances.tolist())
+    if distance == distances[0] and distances[0] < distances[1] and id != str(rows[0]):
+        raise AssertionError("Match is not the nearest reference", match, rows.tolist(), distances.tolist())
+
+
+def timed(function, *args):
+    start_time = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start_time
+
+
+def bench_size(rng, count, query_count, max_radius):
+    hashes = rng.integers(0, np.iinfo(np.uint64).max, (count, HASH_BITS // 64), dtype=np.uint64, endpoint=True)
+    multi_index, build_time = timed(MultiIndex.build, hashes)
+    multi_index.max_radius = max_radius
+    for radius in range(max_radius + 1):
+        multi_index.flip_masks(radius)  # Generated once, outside of the measures
+    index = PHashIndex([str(i) for i in range(count)], hashes, HASH_BITS, multi_index)
+    plain_index = PHashIndex(index.ids, hashes, HASH_BITS)
+    limit = multi_index.max_distance
+
+    results = {'references': count, 'build_s': round(build_time, 3), 'max_distance': limit,
+               'tables_mb': round((multi_index.keys.nbytes + multi_index.rows.nbytes) / 2**20, 1), 'queries': {}}
+    for distance in DISTANCES + ('random',):
+        if distance == 'random':
+            queries = rng.integers(0, np.iinfo(np.uint64).max, (query_count, HASH_BITS // 64), dtype=np.uint64, endpoint=True)
+        else:
+            queries = [flip_bits(rng, hashes[rng.integers(count)], distance) for _ in range(query_count)]
+        brute_times, mih_times, match_times, plain_times, proven = [], [], [], [], 0
+        for query in queries:
+            (rows, distances), seconds = timed(brute_force, hashes, query)
+            brute_times.append(seconds)
+            (mih_rows, mih_distances, bound), seconds = timed(multi_index.search, query, HASH_BITS)
+            mih_times.append(seconds)
+            if mih_distances[0] <= bound:
+                proven += 1
+                if mih_distances[0] != distances[0]:
+                    raise AssertionError("Multi-index hashing missed the nearest reference", distance, int(mih_distances[0]), int(distances[0]))
+            match, seconds = timed(index.match, query, limit)
+            match_times.append(seconds)
+            plain_match, seconds = timed(plain_index.match, query, limit)
+            plain_times.append(seconds)
+            if distances[0] > limit:
+                if match != (None, None, None):
+                    raise AssertionError("Match beyond the maximum distance", distance, match, distances.tolist())
+                continue
+            check_match(match, rows, distances, limit, exact=True)
+            if plain_match != (None, None, None):
+                check_match(plain_match, rows, distances, limit, exact=False)
+        brute_ms, match_ms, plain_ms = np.mean(brute_times) * 1000, np.mean(match_times) * 1000, np.mean(plain_times) * 1000
+        results['queries'][str(distance)] = {
+            'brute_force_ms': round(float(brute_ms), 4),
+            'multi_index_ms': round(float(np.mean(mih_times) * 1000), 4),
+            'proven': round(proven / len(queries), 3),
+            'match_ms': round(float(match_ms), 4),
+            'plain_match_ms': round(float(plain_ms), 4),
+            'match_speedup': round(float(plain_ms / match_ms), 1)}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-n', '--references', default=[50000, 200000, 1000000], type=int, nargs='+', help='catalogue sizes')
+    parser.add_argument('-q', '--queries', default=20, type=int, help='number of queries per distance')
+    parser.add_argument('-r', '--max_radius', default=MultiIndex.max_radius, type=int, help='maximum number of bits flipped in a probed word')
+    parser.add_argument('-s', '--seed', default=0, type=int, help='seed')
+    parser.add_argument('-o', '--output', default='mih.json', help='json results file')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    output = []
+    for count in args.references:
+        results = bench_size(rng, count, args.queries, args.max_radius)
+        output.append(results)
+        print(f"{count} references: tables built in {results['build_s']} s, {results['tables_mb']} MB, matches within {results['max_distance']} bits")
+        print(f"  {'distance':>8} {'brute ms':>10} {'mih ms':>10} {'proven':>7} {'match ms':>10} {'no tables':>10} {'speedup':>8}")
+        for distance, r in results['queries'].items():
+            print(f"  {distance:>8} {r['brute_force_ms']:>10} {r['multi_index_ms']:>10} {r['proven']:>7} {r['match_ms']:>10} {r['plain_match_ms']:>10} {r['match_speedup']:>8}")
+    with open(args.output, 'w', encoding='utf-8') as file:
+        json.dump({'max_radius': args.max_radius, 'seed': args.seed, 'results': output}, file, indent=2)
+    print(f"Wrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""
+Micro-benchmark of '_generate_quad_candidates' against the original
+shapely implementation, on convex hulls of synthetic card contours
+(rounded corners, perspective, noise).
+
+Run from 'src': python -m benchmarks.quad_candidates
+"""
+from itertools import product
+import time
+
+import numpy as np
+import cv2 as cv
+from shapely.geometry.polygon import Polygon
+
+from utils import _convex_hull_polygon, _simplify_polygon, _order_polygon_points, \
+    _generate_point_indices, _line_intersection, _generate_quad_candidates
+
+
+def reference_quad_corners(indices, x, y):
+    """
+    Original scalar corners: returns the four intersection points from the
+    segments defined by the x coordinates (x),
+    y coordinates (y), and the indices.
+    """
+    (i, j, k, l) = indices
+
+    def gpi(index_1, index_2):
+        return _generate_point_indices(index_1, index_2, len(x))
+
+    xis = np.empty(4)
+    yis = np.empty(4)
+    xis.fill(np.nan)
+    yis.fill(np.nan)
+
+    if j <= i or k <= j or l <= k:
+        pass
+    else:
+        (xis[0], yis[0]) = _line_intersection(x[gpi(i, j)],
+                                             y[gpi(i, j)])
+        (xis[1], yis[1]) = _line_intersection(x[gpi(j, k)],
+                                             y[gpi(j, k)])
+        (xis[2], yis[2]) = _line_intersection(x[gpi(k, l)],
+                                             y[gpi(k, l)])
+        (xis[3], yis[3]) = _line_intersection(x[gpi(l, i)],
+                                             y[gpi(l, i)])
+
+    return (xis, yis)
+
+
+def reference_quad_candidates(in_poly):
+    """
+    Original implementation: one shapely containment test for each of the
+    len_poly ** 4 index tuples.
+    """
+    (x_s, y_s) = _order_polygon_points(in_poly[:, 0], in_poly[:, 1])
+    x_s_ave = np.average(x_s)
+    y_s_ave = np.average(y_s)
+    x_shrunk = x_s_ave + 0.9999 * (x_s - x_s_ave)
+    y_shrunk = y_s_ave + 0.9999 * (y_s - y_s_ave)
+    shrunk_poly = Polygon([[x, y] for (x, y) in zip(x_shrunk, y_shrunk)])
+    quads = []
+    for indices in product(range(len(x_s)), repeat=4):
+        (xis, yis) = reference_quad_corners(indices, x_s, y_s)
+        if (np.sum(np.isnan(xis)) + np.sum(np.isnan(yis))) > 0:
+            continue
+        (xis, yis) = _order_polygon_points(xis, yis)
+        quad = Polygon([(xis[0], yis[0]), (xis[1], yis[1]),
+                        (xis[2], yis[2]), (xis[3], yis[3])])
+        if quad.contains(shrunk_poly):
+            quads.append(quad)
+    return quads
+
+
+def card_hull(rng, size=311):
+    """
+    Convex hull of a rounded card seen with a random perspective.
+    """
+    mask = np.zeros((size, size), np.uint8)
+    w, h, r = 63 * 3, 88 * 3, int(rng.uniform(6, 20))
+    card = np.zeros((h, w), np.uint8)
+    cv.rectangle(card, (r, 0), (w - r, h), 255, -1)
+    cv.rectangle(card, (0, r), (w, h - r), 255, -1)
+    for (cx, cy) in ((r, r), (w - r, r), (r, h - r), (w - r, h - r)):
+        cv.circle(card, (cx, cy), r, 255, -1)
+    src = np.float32([[0, 0], [w, 0], [w, h], [0, h]])
+    dst = src * 0.9 + rng.uniform(-15, 15, (4, 2)).astype(np.float32) + 25
+    mask = cv.warpPerspective(card, cv.getPerspectiveTransform(src, dst), (size, size))
+    contours, _ = cv.findContours(mask, cv.RETR_EXTERNAL, cv.CHAIN_APPROX_SIMPLE)
+    contour = max(contours, key=cv.contourArea)
+    contour = contour + rng.integers(-1, 2, contour.shape).astype(contour.dtype)
+    return _convex_hull_polygon(contour)
+
+
+def same_quads(quads_a, quads_b):
+    if len(quads_a) != len(quads_b):
+        return False
+    return all(np.allclose(np.asarray(a.exterior.coords)[:-1], b)
+               for (a, b) in zip(quads_a, quads_b))
+
+
+def run(polys):
+    count = len(polys)
+    vertices = [len(p) for p in polys]
+
+    start_time = time.perf_counter()
+    reference = [reference_quad_candidates(p) for p in polys]
+    reference_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    fast = [_generate_quad_candidates(p) for p in polys]
+    fast_time = time.perf_counter() - start_time
+
+    identical = all(same_quads(a, b) for (a, b) in zip(reference, fast))
+    print(f"{count} hulls, {min(vertices)}-{max(vertices)} vertices after simplification")
+    print(f"reference: {round(1000 * reference_time / count, 3)} ms/hull")
+    print(f"numpy:     {round(1000 * fast_time / count, 3)} ms/hull")
+    print(f"speed-up:  x{round(reference_time / fast_time, 1)}, identical quads: {identical}")
+
+
+def main(count=30, seed=0):
+    rng = np.random.default_rng(seed)
+    hulls = [card_hull(rng) for _ in range(count)]
+    # Default simplification, as used by _get_bounding_quad
+    run([_simplify_polygon(hull) for hull in hulls])
+    # Lighter simplification, leaving more hull vertices
+    run([_simplify_polygon(hull, length_cutoff=0.04) for hull in hulls])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+Recall benchmark of the coarse shortlist of 'PHashIndex.match', on 1024-bit
+hashes (32x32 pHashes) at several catalogue sizes.
+
+References are random packed hashes (seeded). Queries are references with
+a given number of random bits flipped, as photos of cards are usually 200
+to 400 bits away from their reference. Flips are uniform over the hash, so
+the coarse (lowest frequency) bits flip as often as the others: a
+pessimistic model, since these are the most stable bits of real pHashes.
+
+For each size, distance and shortlist length (the default one, scaled with
+the catalogue, and fixed ones), measures the recall of the matches (their
+distance is the brute force nearest one), how often their margin is the
+brute force one, and their latency, at the scanner's maximum distance.
+
+Run from 'src': python -m benchmarks.recall [-n 100000 1000000] [-s 64] [-o recall.json]
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+
+from phashindex import PHashIndex
+from scanner import Scanner
+
+
+HASH_BITS = 1024
+DISTANCES = (100, 200, 300, 400)
+
+
+def flip_bits(rng, hash, count):
+    bits = np.unpackbits(hash.view(np.uint8))
+    bits[rng.choice(bits.size, count, replace=False)] ^= 1
+    return np.packbits(bits).view(np.uint64)
+
+
+def brute_force(hashes, query):
+    """
+    Distances of the two references closest to the query, by a full popcount pass.
+    """
+    distances = np.bitwise_count(hashes ^ query).sum(axis=1, dtype=np.uint32)
+    return np.sort(distances[np.argpartition(distances, 1)[:2]])
+
+
+def bench_size(rng, count, query_count, shortlists, limit):
+    hashes = rng.integers(0, np.iinfo(np.uint64).max, (count, HASH_BITS // 64), dtype=np.uint64, endpoint=True)
+    index = PHashIndex([str(i) for i in range(count)], hashes, HASH_BITS)
+    results = {'references': count, 'default_shortlist': index.shortlist_length(), 'queries': {}}
+    for distance in DISTANCES:
+        queries = [flip_bits(rng, hashes[rng.integers(count)], distance) for _ in range(query_count)]
+        truths = [brute_force(hashes, query) for query in queries]
+        results['queries'][str(distance)] = by_shortlist = {}
+        for shortlist in shortlists:
+            found, exact_margins, seconds = 0, 0, []
+            for query, (nearest, second) in zip(queries, truths):
+                start_time = time.perf_counter()
+                id, match_distance, margin = index.match(query, limit, shortlist)
+                seconds.append(time.perf_counter() - start_time)
+                if nearest > limit:
+                    found += (id is None)
+                    exact_margins += (id is None)
+                elif match_distance == nearest:
+                    found += 1
+                    exact_margins += (margin == min(second, limit + 1) - nearest)
+            by_shortlist['default' if shortlist is None else str(shortlist)] = {
+                'recall': round(found / len(queries), 3),
+                'exact_margins': round(exact_margins / len(queries), 3),
+                'match_ms': round(float(np.mean(seconds) * 1000), 3)}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-n', '--references', default=[100000, 1000000], type=int, nargs='+', help='catalogue sizes')
+    parser.add_argument('-q', '--queries', default=50, type=int, help='number of queries per distance')
+    parser.add_argument('-s', '--shortlists', default=[64], type=int, nargs='*', help='fixed shortlist lengths compared to the default one (0 for an exhaustive search)')
+    parser.add_argument('--seed', default=0, type=int, help='seed')
+    parser.add_argument('-o', '--output', default='recall.json', help='json results file')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    limit = round(Scanner.max_distance * HASH_BITS)
+    shortlists = [None] + args.shortlists
+    output = []
+    for count in args.references:
+        results = bench_size(rng, count, args.queries, shortlists, limit)
+        output.append(results)
+        print(f"{count} references: default shortlist of {results['default_shortlist']}, matches within {limit} bits")
+        print(f"  {'distance':>8} {'shortlist':>9} {'recall':>7} {'margins':>8} {'match ms':>9}")
+        for distance, by_shortlist in results['queries'].items():
+            for shortlist, r in by_shortlist.items():
+                print(f"  {distance:>8} {shortlist:>9} {r['recall']:>7} {r['exact_margins']:>8} {r['match_ms']:>9}")
+    with open(args.output, 'w', encoding='utf-8') as file:
+        json.dump({'max_distance': limit, 'seed': args.seed, 'results': output}, file, indent=2)
+    print(f"Wrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
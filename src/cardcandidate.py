@@ -1,10 +1,10 @@
-from shapely.geometry.polygon import Polygon
 import numpy as np
 
 class CardCandidate:
     image:np.ndarray
-    bounding_poly:Polygon
+    bounding_poly:np.ndarray
+    """ (4, 2) array of the card corners in the preprocessed image """
     
-    def __init__(self, image:np.ndarray, bounding_poly:Polygon):
+    def __init__(self, image:np.ndarray, bounding_poly:np.ndarray):
         self.image = image
         self.bounding_poly = bounding_poly
@@ -0,0 +1,97 @@
+import time
+import threading
+import urllib.parse
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class Downloader:
+    """
+    Thread safe HTTP downloader, for a pool of 'workers' threads: one shared keep-alive session,
+    global rate limits and exponential backoff retries.
+    Requests to the Scryfall API are limited to 'api_rate_limit' per second, as per its guidelines, while its image CDN
+    (*.scryfall.io) is not rate limited: other requests are only limited by 'rate_limit', if set.
+    """
+    user_agent:str = 'mtg-scan/0.1'
+
+    api_hosts:tuple = ('api.scryfall.com',)
+    api_rate_limit:float = 10.
+    """ Maximum number of requests to the 'api_hosts' started per second """
+
+    workers:int
+    rate_limit:float
+    """ Maximum number of requests to other hosts (ex. images) started per second (0 for no limit) """
+    retries:int
+    backoff:float
+    """ Delay before the first retry, doubled at each following retry """
+    timeout:float
+    verbose:bool
+
+    session:requests.Session
+    _lock:threading.Lock
+    _next_request_times:dict
+    """ Whether to an API host -> earliest time of the next request """
+
+    def __init__ (self, workers:int=8, rate_limit:float=0., retries:int=5, backoff:float=0.5, timeout:float=10., verbose:bool=False):
+        self.workers = max (1, workers)
+        self.rate_limit = rate_limit
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.verbose = verbose
+
+        self.session = requests.Session ()
+        self.session.headers.update ({'User-Agent': self.user_agent, 'Accept': '*/*'})
+        adapter = HTTPAdapter (pool_connections=4, pool_maxsize=self.workers, max_retries=0)
+        self.session.mount ('http://', adapter)
+        self.session.mount ('https://', adapter)
+
+        self._lock = threading.Lock ()
+        self._next_request_times = {}
+
+
+    def get (self, url:str):
+        """
+        Downloads the given url. Returns its content, or None if every try failed.
+        """
+        for attempt in range (self.retries + 1):
+            self._wait_rate_limit (url)
+            delay = self.backoff * (2 ** attempt)
+            try:
+                response = self.session.get (url, timeout=self.timeout)
+                if (response.status_code == 200):
+                    return response.content
+                if (response.status_code != 429 and response.status_code < 500):
+                    break # Client errors are not worth retrying
+                if ('Retry-After' in response.headers):
+                    try:
+                        delay = max (delay, float (response.headers['Retry-After']))
+                    except ValueError:
+                        pass
+            except requests.RequestException:
+                pass
+            if (attempt < self.retries):
+                time.sleep (delay)
+        if (self.verbose):
+            print (f"\t\tFailed to retrieve {url}.")
+        return None
+
+
+    def close (self):
+        """
+        Closes the keep-alive connections of the session.
+        """
+        self.session.close ()
+
+
+    def _wait_rate_limit (self, url:str):
+        api = urllib.parse.urlsplit (url).hostname in self.api_hosts
+        rate_limit = self.api_rate_limit if api else self.rate_limit
+        if (rate_limit <= 0):
+            return
+        with self._lock:
+            now = time.monotonic ()
+            request_time = max (now, self._next_request_times.get (api, 0.))
+            self._next_request_times[api] = request_time + 1. / rate_limit
+        if (request_time > now):
+            time.sleep (request_time - now)
@@ -0,0 +1,99 @@
+import os
+import hashlib
+import threading
+
+class ImageCache:
+    """
+    Local on-disk cache of reference card images.
+    Images are stored under their Scryfall id and face, tagged with a digest of their URL so that an
+    updated Scryfall image (new URL) is a cache miss. Least recently used images are evicted past 'max_bytes'.
+    """
+    verbose:bool
+    directory:str
+    max_bytes:int
+    size:int
+    """ Current cache size in bytes, None until first needed """
+    _lock:threading.Lock
+
+    def __init__ (self, directory:str='./data/images', max_bytes:int=16 * 2**30, verbose:bool=False):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.verbose = verbose
+        self.size = None
+        self._lock = threading.Lock ()
+
+
+    def path (self, id:str, face:int, url:str) -> str:
+        digest = hashlib.sha1 (url.encode ('utf-8')).hexdigest ()[:12]
+        return os.path.join (self.directory, id[:2], f"{id}_{face}_{digest}.jpg")
+
+
+    def get (self, id:str, face:int, url:str):
+        """
+        Returns the cached image content, or None on a miss.
+        """
+        path = self.path (id, face, url)
+        try:
+            with open (path, 'rb') as file:
+                content = file.read ()
+            os.utime (path) # Marks as recently used
+            return content
+        except FileNotFoundError:
+            return None
+
+
+    def put (self, id:str, face:int, url:str, content:bytes):
+        """
+        Stores an image, replacing older versions of the same card face, and evicts images if over size.
+        """
+        path = self.path (id, face, url)
+        folder = os.path.dirname (path)
+        os.makedirs (folder, exist_ok=True)
+        with self._lock:
+            self._compute_size ()
+            prefix = f"{id}_{face}_"
+            for entry in os.scandir (folder):
+                if entry.name.startswith (prefix) and entry.path != path:
+                    self.size -= entry.stat ().st_size
+                    os.remove (entry.path)
+            tmp_path = f"{path}.{threading.get_ident ()}.tmp"
+            with open (tmp_path, 'wb') as file:
+                file.write (content)
+            if os.path.exists (path):
+                self.size -= os.path.getsize (path)
+            os.replace (tmp_path, path)
+            self.size += len (content)
+            if (self.size > self.max_bytes):
+                self._evict ()
+
+
+    def _compute_size (self):
+        if (self.size is None):
+            self.size = sum (entry.stat ().st_size for entry in self._entries ())
+
+
+    def _entries (self):
+        if not os.path.isdir (self.directory):
+            return
+        for folder in os.scandir (self.directory):
+            if folder.is_dir ():
+                for entry in os.scandir (folder.path):
+                    if entry.name.endswith ('.jpg'):
+                        yield entry
+
+
+    def _evict (self):
+        """
+        Removes least recently used images until the cache is back under 90% of its maximum size.
+        """
+        entries = sorted (((e.stat ().st_mtime, e.stat ().st_size, e.path) for e in self._entries ()))
+        target = 0.9 * self.max_bytes
+        removed = 0
+        for _, size, path in entries:
+            if (self.size <= target):
+                break
+            os.remove (path)
+            self.size -= size
+            removed += 1
+        if (self.verbose):
+            print (f"\t\tEvicted {removed} cached images.")
@@ -6,13 +6,22 @@ class InputImage:
     """ Original input image """
     
     preprocessed_image:np.ndarray
-    """ Whole image, resized and equalized """
+    """ Whole image, resized (and equalized by a color pre processor) """
+    
+    gray_image:np.ndarray
+    """ Whole image, resized and equalized, in grayscale (thresholding and hashing input) """
     
     thresholded_image:np.ndarray
     """ Whole image, for finding contours """
     
     card_image:np.ndarray
-    """ Cropped image, for pHash """
+    """ Cropped grayscale image, for pHash """
+    
+    card_rect:tuple
+    """ Rotated bounding rectangle of the card in the preprocessed image ((center x, center y), (width, height), angle) """
+    
+    candidates:list
+    """ Every card found in the image (CardCandidate), for multi-card segmentation """
     
     def __init__(self, raw_image):
         self.raw_image = raw_image
@@ -1,10 +1,14 @@
 import os
 import argparse
 import glob
+import json
 import cv2 as cv
 
 from scanner import Scanner
 from save import Save
+from streamscanner import StreamScanner
+from scanserver import ScanServer
+from metrics import metrics, exporter_for
 
 
 def parse_command_line ():
@@ -16,6 +20,15 @@ def parse_command_line ():
     subparser_scan.add_argument ('-o', '--output_path', default='./out_images', help='output path for the results')
     subparser_scan.add_argument ('-p', '--phash_path', default='./phash.dat', help='pre-calculated phash reference file')
     subparser_scan.add_argument ('-v', '--verbose', default=False, action='store_true', help='run with verbose mode')
+    subparser_scan.add_argument ('-w', '--workers', default=None, type=int, help='number of scanning processes (defaults to the number of CPUs)')
+    subparser_scan.add_argument ('-j', '--jsonl', default=False, action='store_true', help='print each result as a JSON line as soon as it is ready')
+    subparser_scan.add_argument ('--prefetch', default=None, type=int, help='maximum number of images read ahead (defaults to twice the number of workers)')
+    subparser_scan.add_argument ('-m', '--multi', default=False, action='store_true', help='identify every card of each image (ex. binder pages)')
+    subparser_scan.add_argument ('-s', '--stream', default=None, nargs='?', const='0', help='scan cards from a video stream: camera index, video file or url (defaults to camera 0)')
+    subparser_scan.add_argument ('--frame_skip', default=3, type=int, help='in stream mode, only analyze 1 frame out of this number')
+    subparser_scan.add_argument ('-t', '--track', default=False, action='store_true', help='look for each card around the previous card position first (fixed scanning setups)')
+    subparser_scan.add_argument ('--max_distance', default=None, type=float, help=f'maximum Hamming distance of a match, relative to the hash size (defaults to {Scanner.max_distance})')
+    subparser_scan.add_argument ('--metrics', default=None, help='write stage latencies and counters to this file at the end (Prometheus text format for .prom files, json otherwise)')
     subparser_scan.add_argument ('-d', '--draw', default=False, action='store_true', help='run with draw mode')
 
     subparser_save = subparser.add_parser ('save')   # Save
@@ -23,6 +36,24 @@ def parse_command_line ():
     subparser_save.add_argument ('-o', '--output_path', default='../phash.dat', help='path for output reference file')
     subparser_save.add_argument ('-v', '--verbose', default=False, action='store_true', help='run with verbose mode')
     subparser_save.add_argument ('-f', '--force_update', default=False, action='store_true', help='update cards data even if already up to date')
+    subparser_save.add_argument ('-n', '--incremental', default=False, action='store_true', help='only hash new or changed cards')
+    subparser_save.add_argument ('-c', '--from_cache', default=False, action='store_true', help='recompute phashes from cached images only, without downloading')
+    subparser_save.add_argument ('--cache_size', default=16., type=float, help='maximum size of the image cache, in GB')
+    subparser_save.add_argument ('-w', '--workers', default=8, type=int, help='number of concurrent image downloads')
+    subparser_save.add_argument ('-r', '--rate_limit', default=0., type=float, help='maximum image requests per second (0 for no limit: the Scryfall image CDN is not rate limited, its API always is, to 10 requests per second)')
+    subparser_save.add_argument ('--hash_workers', default=None, type=int, help='number of hashing processes (defaults to the number of CPUs)')
+    subparser_save.add_argument ('--multi_index', default=False, action='store_true', help='also store multi-index hashing tables in the index, to match near duplicates (scans with a small --max_distance) without a full pass')
+
+    subparser_serve = subparser.add_parser ('serve')   # Scan service
+    subparser_serve.add_argument ('-p', '--port', default=8765, type=int, help='localhost port to listen on')
+    subparser_serve.add_argument ('-u', '--unix_socket', default=None, help='listen on this Unix socket instead of a port')
+    subparser_serve.add_argument ('-v', '--verbose', default=False, action='store_true', help='run with verbose mode')
+    subparser_serve.add_argument ('-m', '--multi', default=False, action='store_true', help='identify every card of each image (ex. binder pages)')
+    subparser_serve.add_argument ('-t', '--track', default=False, action='store_true', help='look for each card around the previous card position first (fixed scanning setups)')
+    subparser_serve.add_argument ('-b', '--max_batch', default=16, type=int, help='maximum number of images scanned together')
+    subparser_serve.add_argument ('--max_delay', default=2., type=float, help='maximum time a request waits for others to be batched with, in ms')
+    subparser_serve.add_argument ('--max_distance', default=None, type=float, help=f'maximum Hamming distance of a match, relative to the hash size (defaults to {Scanner.max_distance})')
+    subparser_serve.add_argument ('--metrics', default=None, help='periodically write stage latencies and counters to this file (Prometheus text format for .prom files, json otherwise)')
 
     args = parser.parse_args ()
 
@@ -30,22 +61,55 @@ def parse_command_line ():
 
 
 def run_scan (args:argparse.ArgumentParser):
-    # Reads image paths
-    image_paths = glob.glob (args.input_path + "*.jpg")
-    images = [cv.imread (path) for path in image_paths]
+    if (args.metrics is not None):
+        metrics.enable ()
+    try:
+        if (args.stream is not None):
+            run_stream_scan (args)
+        else:
+            run_batch_scan (args)
+    finally:
+        if (args.metrics is not None):
+            exporter_for (args.metrics).export (metrics)
+
+
+def run_batch_scan (args:argparse.ArgumentParser):
+    # Lists image paths lazily
+    image_paths = glob.iglob (args.input_path + "*.jpg")
     
-    # Scans obtained images
-    s = Scanner (args.verbose)
-    ids = [s.scan (image) for image in images]
+    # Scans images, each worker process reading its own
+    s = Scanner (args.verbose, args.multi, args.track, max_distance=args.max_distance)
+    if (args.jsonl):
+        for result in s.scan_stream (image_paths, args.workers, args.prefetch):
+            print (json.dumps (result), flush=True)
+    else:
+        ids = list (s.scan_batch (image_paths, args.workers, args.prefetch))
+        print (ids)
     
-    print (ids)
+    
+def run_stream_scan (args:argparse.ArgumentParser):
+    source = int (args.stream) if args.stream.isdigit () else args.stream
+    s = StreamScanner (Scanner (args.verbose, track_roi=args.track, max_distance=args.max_distance), args.frame_skip, verbose=args.verbose)
+    for result in s.run (source):
+        print (json.dumps (result), flush=True)
     
     
 def run_save (args:argparse.ArgumentParser):
-    s = Save (args.verbose)
+    s = Save (args.verbose, args.workers, args.rate_limit, int (args.cache_size * 2**30), args.hash_workers, args.multi_index)
     
-    s.update_cards (args.force_update)
-    s.update_ref_phash (True)
+    try:
+        if (not args.from_cache):
+            s.update_cards (args.force_update)
+        s.update_ref_phash (True, args.incremental, args.from_cache)
+    finally:
+        s.close ()
+
+
+def run_serve (args:argparse.ArgumentParser):
+    metrics.enable ()
+    exporter = exporter_for (args.metrics) if args.metrics is not None else None
+    s = ScanServer (Scanner (args.verbose, args.multi, args.track, max_distance=args.max_distance), args.max_batch, args.max_delay / 1000, exporter=exporter, verbose=args.verbose)
+    s.run (args.port, args.unix_socket)
 
 
 def main ():
@@ -63,6 +127,8 @@ def main ():
         run_scan (args)
     if (args.command == 'save'):
         run_save(args)
+    if (args.command == 'serve'):
+        run_serve (args)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,276 @@
+import os
+import json
+import math
+import time
+import functools
+
+
+class Histogram:
+    """
+    Latency histogram (ns) over logarithmic buckets, 4 per octave from 1 µs to about 18 min: constant memory whatever the number
+    of observations, quantiles within 19 % (the width of a bucket).
+    """
+    min_ns:int = 1000
+    per_octave:int = 4
+    bucket_count:int = 4 * 30 + 1
+    """ Buckets, the last one for everything above the others """
+
+    def __init__ (self):
+        self.counts = [0] * self.bucket_count
+        self.count = 0
+        self.sum_ns = 0
+        self.max_ns = 0
+
+    @classmethod
+    def bound_ns (cls, bucket:int) -> float:
+        """ Upper bound of a bucket """
+        return cls.min_ns * 2 ** (bucket / cls.per_octave)
+
+    def observe (self, ns:int):
+        bucket = 0 if ns <= self.min_ns else min (math.ceil (math.log2 (ns / self.min_ns) * self.per_octave), self.bucket_count - 1)
+        self.counts[bucket] += 1
+        self.count += 1
+        self.sum_ns += ns
+        if (ns > self.max_ns):
+            self.max_ns = ns
+
+    def merge (self, other:'Histogram'):
+        """ Adds the observations of another histogram """
+        self.counts = [count + other_count for count, other_count in zip (self.counts, other.counts)]
+        self.count += other.count
+        self.sum_ns += other.sum_ns
+        self.max_ns = max (self.max_ns, other.max_ns)
+
+    def quantile (self, q:float) -> float:
+        """
+        Estimated quantile (ns): the upper bound of the bucket holding it, linearly interpolated, and at most the maximum.
+        """
+        if (self.count == 0):
+            return 0.
+        rank = q * self.count
+        cumulated = 0
+        for bucket, count in enumerate (self.counts):
+            if (count > 0 and cumulated + count >= rank):
+                lower = 0. if bucket == 0 else self.bound_ns (bucket - 1)
+                return min (lower + (self.bound_ns (bucket) - lower) * (rank - cumulated) / count, self.max_ns)
+            cumulated += count
+        return float (self.max_ns)
+
+    def summary (self) -> dict:
+        """ Count, mean, p50, p95, p99 and max, in ms """
+        ms = lambda ns: round (ns / 1e6, 4)
+        return {'count': self.count, 'mean_ms': ms (self.sum_ns / max (self.count, 1)), 'p50_ms': ms (self.quantile (0.5)),
+                'p95_ms': ms (self.quantile (0.95)), 'p99_ms': ms (self.quantile (0.99)), 'max_ms': ms (self.max_ns)}
+
+
+class _Span:
+    __slots__ = ('metrics', 'name', 'start_ns')
+
+    def __init__ (self, metrics, name:str):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__ (self):
+        self.start_ns = time.perf_counter_ns ()
+        return self
+
+    def __exit__ (self, *exc_info):
+        self.metrics.observe (self.name, time.perf_counter_ns () - self.start_ns)
+        return False
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__ (self):
+        return self
+
+    def __exit__ (self, *exc_info):
+        return False
+
+
+_null_span = _NullSpan ()
+
+
+class Metrics:
+    """
+    Process-wide instrumentation: named spans (timed with perf_counter_ns into latency histograms), counters, and hooks
+    called at the end of each span (tracing). Disabled by default: spans are then a shared no-op context manager and
+    counters are ignored, so instrumented hot paths cost one attribute check.
+    Not thread safe: each process should record from a single thread (the scanning thread).
+    """
+    enabled:bool = False
+    counters:dict
+    """ Name -> value """
+    histograms:dict
+    """ Span name -> Histogram """
+    hooks:list
+    """ Callables (span name, ns) called at the end of each span """
+
+    def __init__ (self):
+        self.counters = {}
+        self.histograms = {}
+        self.hooks = []
+
+
+    def enable (self, trace:bool=False):
+        """
+        Starts recording. If 'trace', also prints every span as it ends (verbose mode).
+        """
+        self.enabled = True
+        if (trace and print_span not in self.hooks):
+            self.hooks.append (print_span)
+
+
+    def disable (self):
+        self.enabled = False
+
+
+    def reset (self):
+        self.counters = {}
+        self.histograms = {}
+
+
+    def collect (self) -> 'Metrics':
+        """
+        Takes the counters and histograms recorded so far (ex. by a worker process, to be merged into the metrics of the main
+        process, see 'merge'), and starts over.
+        """
+        collected = Metrics ()
+        collected.counters, collected.histograms = self.counters, self.histograms
+        self.reset ()
+        return collected
+
+
+    def merge (self, other:'Metrics'):
+        """
+        Adds the counters and histograms of other metrics (ex. collected in another process). Hooks are not called.
+        """
+        for name, value in other.counters.items ():
+            self.counters[name] = self.counters.get (name, 0) + value
+        for name, histogram in other.histograms.items ():
+            if (name not in self.histograms):
+                self.histograms[name] = Histogram ()
+            self.histograms[name].merge (histogram)
+
+
+    def span (self, name:str):
+        """
+        Context manager timing its block into the 'name' histogram.
+        """
+        return _Span (self, name) if self.enabled else _null_span
+
+
+    def timed (self, name:str):
+        """
+        Decorator timing each call of a function into the 'name' histogram.
+        """
+        def decorator (function):
+            @functools.wraps (function)
+            def wrapper (*args, **kwargs):
+                if (not self.enabled):
+                    return function (*args, **kwargs)
+                with _Span (self, name):
+                    return function (*args, **kwargs)
+            return wrapper
+        return decorator
+
+
+    def observe (self, name:str, ns:int):
+        """
+        Records a duration (ns) into the 'name' histogram.
+        """
+        if (not self.enabled):
+            return
+        histogram = self.histograms.get (name)
+        if (histogram is None):
+            histogram = self.histograms[name] = Histogram ()
+        histogram.observe (ns)
+        for hook in self.hooks:
+            hook (name, ns)
+
+
+    def count (self, name:str, value=1):
+        if (self.enabled):
+            self.counters[name] = self.counters.get (name, 0) + value
+
+
+    def snapshot (self) -> dict:
+        """
+        Counters and span summaries (count, mean, p50, p95, p99 and max, in ms).
+        """
+        return {'counters': dict (self.counters),
+                'spans': {name: histogram.summary () for name, histogram in sorted (list (self.histograms.items ()))}}
+
+
+def print_span (name:str, ns:int):
+    print (f"\t\t{name}: {round (ns / 1e6, 3)} ms")
+
+
+metrics = Metrics ()
+""" Metrics of this process """
+
+
+class JsonExporter:
+    """
+    Writes metrics snapshots to a json file.
+    """
+    filename:str
+
+    def __init__ (self, filename:str):
+        self.filename = filename
+
+    def export (self, metrics:Metrics):
+        snapshot = {'time': round (time.time (), 3), 'pid': os.getpid (), **metrics.snapshot ()}
+        _write_atomically (self.filename, json.dumps (snapshot, indent=2))
+
+
+class PrometheusExporter:
+    """
+    Writes metrics in the Prometheus text format (ex. for the node exporter textfile collector): counters as
+    '<prefix>_<name>_total', spans as '<prefix>_<name>_seconds' histograms.
+    """
+    filename:str
+    """ None if only used for its text (ex. served over HTTP) """
+    prefix:str
+
+    def __init__ (self, filename:str=None, prefix:str='mtgscan'):
+        self.filename = filename
+        self.prefix = prefix
+
+    def text (self, metrics:Metrics) -> str:
+        lines = []
+        for name, value in sorted (list (metrics.counters.items ())):
+            metric = self._metric_name (name) + '_total'
+            lines += [f"# TYPE {metric} counter", f"{metric} {value}"]
+        for name, histogram in sorted (list (metrics.histograms.items ())):
+            metric = self._metric_name (name) + '_seconds'
+            lines.append (f"# TYPE {metric} histogram")
+            cumulated = 0
+            for bucket, count in enumerate (histogram.counts[:-1]):
+                cumulated += count
+                lines.append (f'{metric}_bucket{{le="{histogram.bound_ns (bucket) / 1e9:.9g}"}} {cumulated}')
+            lines += [f'{metric}_bucket{{le="+Inf"}} {histogram.count}',
+                      f"{metric}_sum {histogram.sum_ns / 1e9:.9g}",
+                      f"{metric}_count {histogram.count}"]
+        return '\n'.join (lines) + '\n'
+
+    def export (self, metrics:Metrics):
+        _write_atomically (self.filename, self.text (metrics))
+
+    def _metric_name (self, name:str) -> str:
+        return self.prefix + '_' + ''.join (c if c.isalnum () else '_' for c in name)
+
+
+def exporter_for (filename:str):
+    """
+    Prometheus exporter for '.prom' files, json exporter otherwise.
+    """
+    return PrometheusExporter (filename) if filename.endswith ('.prom') else JsonExporter (filename)
+
+
+def _write_atomically (filename:str, text:str):
+    os.makedirs (os.path.dirname (filename) or '.', exist_ok=True)
+    with open (filename + '.tmp', 'w', encoding='utf-8') as file:
+        file.write (text)
+    os.replace (filename + '.tmp', filename)
@@ -0,0 +1,102 @@
+import itertools
+import numpy as np
+
+
+class MultiIndex:
+    """
+    Multi-index hashing (Norouzi et al.) over packed hashes, for exact Hamming search in sublinear time when the nearest
+    references are close. Each hash is split into its 64-bit words, and each word position has its own table: the references
+    sorted by that word, searched with 'searchsorted'. A reference within d bits of a query has at least one word within
+    d // words bits of the query's word (pigeonhole), so probing every table with the query words and their variants with up
+    to r bits flipped finds every reference within words * (r + 1) - 1 bits. The probe radius grows until the two nearest
+    references (or the absence of any within the maximum distance) are proven, or 'max_radius' is reached.
+    Queries far from every reference (ex. photos of cards, rather than near duplicates) cannot be proven at a small radius:
+    the search gives up as soon as the references found give no sign of a provable one, for a few lookups.
+    With 64-bit words, only near duplicates are provable (31 bits for 1024-bit hashes at radius 1, see 'max_distance'), while photos
+    of cards are usually 200 to 400 bits away from their references: the tables are an opt-in for near duplicate matching.
+    """
+    hashes:np.ndarray
+    """ (n, words) uint64 matrix of packed hashes """
+    keys:np.ndarray
+    """ (words, n) uint64 matrix: the words of each position, sorted """
+    rows:np.ndarray
+    """ (words, n) uint32 matrix: the row of each key """
+
+    max_radius:int = 1
+    """ Maximum number of bits flipped in a probed word (64 probes a word at 1 bit, 2016 at 2 bits) """
+
+    _masks:dict = {}
+    """ Radius -> every uint64 with that number of bits set """
+
+    def __init__ (self, hashes:np.ndarray, keys:np.ndarray, rows:np.ndarray):
+        self.hashes = hashes
+        self.keys = keys
+        self.rows = rows
+
+
+    @property
+    def max_distance (self) -> int:
+        """ Distance up to which every reference is probed at 'max_radius': searches within it are always exact """
+        return self.keys.shape[0] * (self.max_radius + 1) - 1
+
+
+    @classmethod
+    def build (cls, hashes:np.ndarray):
+        """
+        Builds the tables of a (n, words) packed hash matrix, in bulk.
+        """
+        rows = np.argsort (hashes, axis=0, kind='stable').T.astype (np.uint32)
+        keys = np.take_along_axis (hashes, rows.T.astype (np.intp), axis=0).T
+        return cls (hashes, np.ascontiguousarray (keys), np.ascontiguousarray (rows))
+
+
+    @classmethod
+    def flip_masks (cls, radius:int) -> np.ndarray:
+        masks = cls._masks.get (radius)
+        if (masks is None):
+            masks = np.array ([sum (1 << bit for bit in bits) for bits in itertools.combinations (range (64), radius)], dtype=np.uint64)
+            cls._masks[radius] = masks
+        return masks
+
+
+    def search (self, query:np.ndarray, limit:int) -> tuple[np.ndarray, np.ndarray, int]:
+        """
+        Returns the rows of the two references closest to a packed hash among those probed, their distances ((2,) arrays, rows -1
+        when not found), and the distance up to which every reference was probed: found references within it are exact.
+        Stops as soon as both are proven, or every reference within 'limit' is, or, for a 'limit' beyond 'max_distance', the closest
+        references found so far (if any) are too far to be proven at the next radius.
+        """
+        words = self.keys.shape[0]
+        best_rows = np.full (2, -1, dtype=np.int64)
+        best_distances = np.full (2, np.iinfo (np.uint32).max, dtype=np.uint32)
+        seen = np.zeros (0, dtype=np.int64)
+        bound = -1
+        for radius in range (self.max_radius + 1):
+            # Probes every table with the query words with 'radius' bits flipped
+            probes = query[:, None] ^ self.flip_masks (radius)[None, :]
+            candidates = []
+            for word in range (words):
+                keys = self.keys[word]
+                starts = keys.searchsorted (probes[word], 'left')
+                ends = keys.searchsorted (probes[word], 'right')
+                lengths = ends - starts
+                if (lengths.any ()):
+                    # Positions of every key in the matching [start, end) ranges
+                    positions = np.repeat (starts - np.cumsum (lengths) + lengths, lengths) + np.arange (lengths.sum ())
+                    candidates.append (self.rows[word][positions])
+            bound = words * (radius + 1) - 1
+
+            if (len (candidates) > 0):
+                candidates = np.setdiff1d (np.concatenate (candidates).astype (np.int64), seen)
+                seen = np.union1d (seen, candidates)
+                if (len (candidates) > 0):
+                    distances = np.bitwise_count (self.hashes[candidates] ^ query).sum (axis=1, dtype=np.uint32)
+                    merged_distances = np.concatenate ((best_distances, distances))
+                    order = np.argsort (merged_distances, kind='stable')[:2]
+                    best_rows = np.concatenate ((best_rows, candidates))[order]
+                    best_distances = merged_distances[order]
+            if (best_distances[1] <= bound or limit <= bound):
+                break
+            if (limit > self.max_distance and best_distances[0 if best_distances[0] > bound else 1] > words * (radius + 2) - 1):
+                break # Gives up
+        return best_rows, best_distances, bound
@@ -0,0 +1,73 @@
+import numpy as np
+import cv2 as cv
+
+from utils import pack_bits
+
+
+class PHasher:
+    """
+    Perceptual hash (pHash) shared by the reference builder and the scanner.
+    Images are reduced to (hash_size * highfreq_factor)² pixels, transformed by a 2D DCT, and each coefficient of the
+    hash_size x hash_size lowest frequencies gives a bit: whether it is above their median.
+    Hashes are returned packed, row-major and most significant bit first, in uint64 words (the layout of PHashIndex).
+    Images of a batch are transformed together, row by row, by two cv.dct passes over the whole stack.
+    """
+    hash_size:int = 32
+    """ Hashes are hash_size x hash_size bits """
+
+    highfreq_factor:int = 4
+    """ Reduced image side, relative to hash_size """
+
+    _stack:np.ndarray = None
+
+    def __init__ (self, hash_size:int=hash_size, highfreq_factor:int=highfreq_factor):
+        self.hash_size = hash_size
+        self.highfreq_factor = highfreq_factor
+
+
+    @property
+    def hash_bits (self) -> int:
+        return self.hash_size ** 2
+
+
+    @property
+    def words (self) -> int:
+        """ Number of uint64 words of a packed hash """
+        return -(-self.hash_bits // 64)
+
+
+    def hash (self, image:np.ndarray) -> np.ndarray:
+        """
+        Hashes a grayscale uint8 image (BGR images are converted). Returns its packed hash, a (words,) uint64 array.
+        """
+        return self.hash_batch ([image])[0]
+
+
+    def hash_batch (self, images) -> np.ndarray:
+        """
+        Hashes a sequence of grayscale uint8 images (of any sizes, BGR images are converted) in one pass.
+        Returns their packed hashes, a (n, words) uint64 matrix.
+        """
+        side = self.hash_size * self.highfreq_factor
+        count = len (images)
+        if (count == 0):
+            return np.zeros ((0, self.words), dtype=np.uint64)
+
+        # Reduced images, stacked in a reused buffer
+        if (self._stack is None or self._stack.shape[0] < count or self._stack.shape[1] != side):
+            self._stack = np.empty ((count, side, side), dtype=np.uint8)
+        stack = self._stack[:count]
+        for i, image in enumerate (images):
+            if (image.ndim == 3):
+                image = cv.cvtColor (image, cv.COLOR_BGR2GRAY)
+            cv.resize (image, (side, side), dst=stack[i], interpolation=cv.INTER_AREA)
+
+        # 2D DCT, restricted to the low frequencies: a DCT of every image row, then of every column of the kept coefficients
+        rows = cv.dct (stack.reshape (count * side, side).astype (np.float32), flags=cv.DCT_ROWS)
+        columns = rows.reshape (count, side, side)[:, :, :self.hash_size].transpose (0, 2, 1)
+        columns = cv.dct (np.ascontiguousarray (columns).reshape (count * self.hash_size, side), flags=cv.DCT_ROWS)
+        low_frequencies = columns.reshape (count, self.hash_size, side)[:, :, :self.hash_size].transpose (0, 2, 1)
+
+        # Bits: coefficients above the median, packed into zero-padded words
+        low_frequencies = low_frequencies.reshape (count, self.hash_bits)
+        return pack_bits (low_frequencies > np.median (low_frequencies, axis=1, keepdims=True), batch=True)
@@ -0,0 +1,344 @@
+import os
+import math
+import base64
+import numpy as np
+
+from referenceimage import ReferenceImage
+from multiindex import MultiIndex
+
+class PHashIndex:
+    """
+    Nearest neighbour index over reference pHashes.
+    Every hash is stored as packed uint64 words in a single contiguous matrix,
+    so that a query is answered with vectorized XOR + popcount passes.
+    Queries are matched in two stages: the coarse hashes (the 8x8 lowest frequency bits of each pHash, one word)
+    of every reference shortlist the closest candidates, then only those are reranked by their full hashes.
+    A match reports its distance and its margin to the second closest reference, and can be bounded by a maximum distance
+    (the rerank of the shortlist stops early when every candidate is beyond it; the coarse pass always scans every reference).
+    Optionally, queries bounded by a maximum distance small enough are answered exactly by multi-index hashing (near duplicates).
+    """
+
+    file_magic:bytes = b'MTGPHIDX'
+    file_version:int = 3
+    file_header = np.dtype ([('magic', 'S8'), ('version', '<u4'), ('hash_bits', '<u4'), ('count', '<u8'),
+                             ('words', '<u4'), ('id_width', '<u4'), ('hashes_offset', '<u8'), ('ids_offset', '<u8'),
+                             ('tables', '<u4'), ('tables_offset', '<u8'), ('coarse_offset', '<u8')])
+    file_alignment:int = 64
+
+    ids:list
+    """ Reference ids, row-aligned with 'hashes' (a fixed-width bytes array when memory-mapped) """
+
+    hashes:np.ndarray
+    """ (n, words) uint64 matrix of packed hashes """
+
+    hash_bits:int
+    """ Number of meaningful bits in each hash """
+
+    coarse_hashes:np.ndarray
+    """ (n,) uint64 coarse hashes (memory-mapped along with the hashes), None if the hashes are not square pHashes larger than 8x8 (exhaustive search only) """
+
+    shortlist_size:int = 64
+    """ Minimum number of references shortlisted by their coarse hashes and reranked by their full hashes (0 for an exhaustive search) """
+
+    shortlist_fraction:float = 1 / 64
+    """ Fraction of the references shortlisted: the shortlist grows with the index, so that recall does not drop as it grows """
+
+    prune_words:int = 8
+    """ Number of words of the shortlisted hashes summed between two checks of the maximum distance (rerank only) """
+
+    multi_index:MultiIndex
+    """ Multi-index hashing tables, None if not built (the default: only worth it to match near duplicates, see 'match_batch') """
+
+    def __init__ (self, ids, hashes:np.ndarray, hash_bits:int, multi_index:MultiIndex=None, coarse_hashes:np.ndarray=None):
+        self.ids = ids
+        self.hashes = hashes
+        self.hash_bits = hash_bits
+        self.multi_index = multi_index
+        side = math.isqrt (hash_bits)
+        if (coarse_hashes is None and side * side == hash_bits and side % 8 == 0 and side > 8):
+            coarse_hashes = self.coarse (hashes)
+        self.coarse_hashes = coarse_hashes
+
+
+    @staticmethod
+    def encode (hash:np.ndarray) -> str:
+        """
+        Encodes a packed hash into its json form: the base64 of its fixed-width bytes.
+        """
+        return base64.b64encode (np.ascontiguousarray (hash, dtype=np.uint64).tobytes ()).decode ('ascii')
+
+
+    @staticmethod
+    def decode (phash:str, hash_bits:int) -> np.ndarray:
+        """
+        Decodes a json reference hash (see 'encode') into a packed hash.
+        """
+        hash = np.frombuffer (base64.b64decode (phash), dtype=np.uint64)
+        if (hash.size != -(-hash_bits // 64)):
+            raise ValueError ("Reference hash size does not match", hash.size * 64, hash_bits)
+        return hash
+
+
+    @classmethod
+    def from_references (cls, ref_images, hash_bits:int=ReferenceImage.hash_size ** 2, multi_index:bool=False):
+        """
+        Builds an index from the json references ({'id', 'phash'} dicts), with multi-index hashing tables if 'multi_index'.
+        """
+        ids = [r['id'] for r in ref_images]
+        hashes = np.zeros ((len (ref_images), -(-hash_bits // 64)), dtype=np.uint64)
+        for i, r in enumerate (ref_images):
+            hashes[i] = cls.decode (r['phash'], hash_bits)
+        return cls (ids, hashes, hash_bits, MultiIndex.build (hashes) if multi_index else None)
+
+
+    @classmethod
+    def load (cls, filename:str):
+        """
+        Memory-maps a binary index written by 'write'. Pages are loaded lazily and shared between processes.
+        """
+        data = np.memmap (filename, dtype=np.uint8, mode='r')
+        header = data[:cls.file_header.itemsize].view (cls.file_header)[0]
+        if (header['magic'] != cls.file_magic):
+            raise ValueError ("Not a pHash index file", filename)
+        if (header['version'] != cls.file_version):
+            raise ValueError ("Unsupported pHash index version", int (header['version']))
+        count, words, id_width = int (header['count']), int (header['words']), int (header['id_width'])
+        hashes_offset, ids_offset = int (header['hashes_offset']), int (header['ids_offset'])
+        hashes = data[hashes_offset:hashes_offset + count * words * 8].view (np.uint64).reshape (count, words)
+        ids = data[ids_offset:ids_offset + count * id_width].view (f'S{max (id_width, 1)}')
+        coarse_hashes, coarse_offset = None, int (header['coarse_offset'])
+        if (coarse_offset > 0):
+            coarse_hashes = data[coarse_offset:coarse_offset + count * 8].view (np.uint64)
+        multi_index = None
+        if (header['tables'] > 0 and count > 0):
+            tables, keys_offset = int (header['tables']), int (header['tables_offset'])
+            rows_offset = cls._align (keys_offset + tables * count * 8)
+            keys = data[keys_offset:keys_offset + tables * count * 8].view (np.uint64).reshape (tables, count)
+            rows = data[rows_offset:rows_offset + tables * count * 4].view (np.uint32).reshape (tables, count)
+            multi_index = MultiIndex (hashes, keys, rows)
+        return cls (ids, hashes, int (header['hash_bits']), multi_index, coarse_hashes)
+
+
+    def write (self, filename:str):
+        """
+        Writes the index as a versioned binary file: header, packed hash matrix, fixed-width id table, coarse hashes if any,
+        then the multi-index hashing tables if any (sorted keys, then their rows).
+        The file is written aside and renamed, so processes still mapping the previous version are unaffected.
+        """
+        ids = np.array ([str (id).encode ('utf-8') for id in self.ids], dtype=bytes)
+        id_width = ids.dtype.itemsize if len (ids) > 0 else 0
+        words = self.hashes.shape[1] if self.hashes.ndim == 2 else 0
+
+        hashes_offset = self._align (self.file_header.itemsize)
+        ids_offset = self._align (hashes_offset + self.hashes.nbytes)
+        coarse_offset = self._align (ids_offset + ids.nbytes) if self.coarse_hashes is not None else 0
+        coarse_nbytes = self.coarse_hashes.nbytes if self.coarse_hashes is not None else 0
+        tables_offset = self._align (max (ids_offset + ids.nbytes, coarse_offset + coarse_nbytes))
+        tables = self.multi_index.keys.shape[0] if self.multi_index is not None else 0
+
+        header = np.zeros (1, dtype=self.file_header)
+        header['magic'] = self.file_magic
+        header['version'] = self.file_version
+        header['hash_bits'] = self.hash_bits
+        header['count'] = len (self.ids)
+        header['words'] = words
+        header['id_width'] = id_width
+        header['hashes_offset'] = hashes_offset
+        header['ids_offset'] = ids_offset
+        header['tables'] = tables
+        header['tables_offset'] = tables_offset
+        header['coarse_offset'] = coarse_offset
+
+        os.makedirs (os.path.dirname (filename) or '.', exist_ok=True)
+        tmp_filename = filename + '.tmp'
+        with open (tmp_filename, 'wb') as file:
+            file.write (header.tobytes ())
+            file.write (bytes (hashes_offset - file.tell ()))
+            file.write (np.ascontiguousarray (self.hashes, dtype='<u8').tobytes ())
+            file.write (bytes (ids_offset - file.tell ()))
+            file.write (ids.tobytes ())
+            if (self.coarse_hashes is not None):
+                file.write (bytes (coarse_offset - file.tell ()))
+                file.write (np.ascontiguousarray (self.coarse_hashes, dtype='<u8').tobytes ())
+            if (tables > 0):
+                file.write (bytes (tables_offset - file.tell ()))
+                file.write (np.ascontiguousarray (self.multi_index.keys, dtype='<u8').tobytes ())
+                file.write (bytes (self._align (file.tell ()) - file.tell ()))
+                file.write (np.ascontiguousarray (self.multi_index.rows, dtype='<u4').tobytes ())
+        os.replace (tmp_filename, filename)
+
+
+    @classmethod
+    def _align (cls, offset:int) -> int:
+        return -(-offset // cls.file_alignment) * cls.file_alignment
+
+
+    def id_at (self, row:int) -> str:
+        id = self.ids[row]
+        return id.decode ('utf-8') if isinstance (id, bytes) else id
+
+
+    def __len__ (self):
+        return len (self.ids)
+
+
+    def _check_query (self, hashes:np.ndarray):
+        if (hashes.shape[-1] != self.hashes.shape[1]):
+            raise ValueError ("Query hash size does not match the references", hashes.shape[-1] * 64, self.hash_bits)
+
+
+    def distances (self, hash:np.ndarray) -> np.ndarray:
+        """
+        Returns the Hamming distance between the given packed hash and every reference.
+        """
+        hash = np.asarray (hash, dtype=np.uint64)
+        self._check_query (hash)
+        return np.bitwise_count (np.bitwise_xor (self.hashes, hash)).sum (axis=1, dtype=np.uint32)
+
+
+    def coarse (self, hashes:np.ndarray) -> np.ndarray:
+        """
+        Returns the coarse hashes of packed pHashes (a (n, words) matrix): the first byte of each of their 8 first rows of bits,
+        that is the bits of their 8x8 lowest frequencies, in one uint64 word each.
+        """
+        row_bytes = math.isqrt (self.hash_bits) // 8
+        hash_bytes = np.ascontiguousarray (hashes, dtype=np.uint64).reshape (-1, self.hashes.shape[1]).view (np.uint8)
+        return np.ascontiguousarray (hash_bytes[:, :8 * row_bytes:row_bytes]).view (np.uint64).ravel ()
+
+
+    def shortlist_length (self) -> int:
+        """
+        Default number of shortlisted references: 'shortlist_fraction' of the references, at least 'shortlist_size'.
+        """
+        if (self.shortlist_size <= 0):
+            return 0
+        return max (self.shortlist_size, math.ceil (len (self.ids) * self.shortlist_fraction))
+
+
+    def match_batch (self, hashes, max_distance:int=None, shortlist:int=None, block_rows:int=1 << 14) -> list:
+        """
+        Matches packed hashes (a (n, words) matrix) together. Returns an (id, distance, margin) tuple for each: the closest reference,
+        its Hamming distance, and how much farther the second closest reference is ('max_distance' + 1 - distance when it lies beyond
+        'max_distance', or when there is none). Hashes with no reference within 'max_distance' bits get (None, None, None).
+        Hashes are searched among the shortlisted references (see 'shortlist_length'), or by multi-index hashing if the index has its
+        tables and 'max_distance' is within the distance they prove (near duplicates).
+        Margins are exact with an exhaustive search (shortlist 0, or an index no larger than the shortlist) or multi-index hashing.
+        Among the shortlisted references, the runner-up is the second closest of the shortlist: the margin is overstated when the true
+        runner-up was not shortlisted (as is the match, if the true closest reference was not).
+        """
+        if (len (hashes) == 0 or len (self.ids) == 0):
+            return [(None, None, None)] * len (hashes)
+        queries = np.asarray (hashes, dtype=np.uint64)
+        self._check_query (queries)
+        shortlist = self.shortlist_length () if shortlist is None else shortlist
+        limit = self.hash_bits if max_distance is None else min (max_distance, self.hash_bits)
+        rows = np.full ((len (queries), 2), -1, dtype=np.int64)
+        distances = np.full ((len (queries), 2), np.iinfo (np.uint32).max, dtype=np.uint32)
+
+        # Exact first stage, only when multi-index hashing can prove every match within the maximum distance
+        # (not worth it on indexes of a shortlist size, searched exhaustively, which also gives exact margins)
+        pending = np.ones (len (queries), dtype=bool)
+        if (self.multi_index is not None and limit <= self.multi_index.max_distance and len (self.ids) > self.shortlist_size):
+            for q, query in enumerate (queries):
+                rows[q], distances[q], bound = self.multi_index.search (query, limit)
+                if (distances[q, 1] <= bound or limit <= bound):
+                    pending[q] = False
+                    distances[q, 1] = min (distances[q, 1], bound + 1) # References not found are farther than 'bound'
+
+        if (pending.any ()):
+            if (self.coarse_hashes is None or shortlist <= 0 or shortlist >= len (self.ids)):
+                pending_rows, pending_distances = self._nearest_rows (queries[pending], block_rows)
+            else:
+                pending_rows, pending_distances = self._reranked_rows (queries[pending], shortlist, block_rows * self.hashes.shape[1], limit)
+            # The references found by multi-index hashing are exact, even unproven (ex. a proven nearest one without its runner-up)
+            rows[pending], distances[pending] = self._merged_rows (rows[pending], distances[pending], pending_rows, pending_distances)
+        matches = []
+        for (row, _), (distance, second_distance) in zip (rows.tolist (), distances.tolist ()):
+            if (row < 0 or distance > limit):
+                matches.append ((None, None, None))
+            else:
+                matches.append ((self.id_at (row), distance, min (second_distance, limit + 1) - distance))
+        return matches
+
+
+    def match (self, hash:np.ndarray, max_distance:int=None, shortlist:int=None):
+        """
+        Matches a packed hash. Returns (id, distance, margin), see 'match_batch'.
+        """
+        return self.match_batch (np.asarray (hash, dtype=np.uint64)[None], max_distance, shortlist)[0]
+
+
+    def _nearest_rows (self, queries:np.ndarray, block_rows:int) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Exhaustive search: returns the rows of the two references closest to each query, and their distances
+        ((n, 2) matrices, rows -1 when not found).
+        """
+        candidate_rows, candidate_distances = [], []
+        for start in range (0, len (self.ids), block_rows):
+            block = self.hashes[start:start + block_rows]
+            distances = np.bitwise_count (np.bitwise_xor (block[None, :, :], queries[:, None, :])).sum (axis=2, dtype=np.uint32)
+            rows, distances = self._two_closest (np.broadcast_to (np.arange (start, start + len (block)), distances.shape), distances)
+            candidate_rows.append (rows)
+            candidate_distances.append (distances)
+        if (len (candidate_rows) == 1):
+            return candidate_rows[0], candidate_distances[0]
+        return self._two_closest (np.concatenate (candidate_rows, axis=1), np.concatenate (candidate_distances, axis=1))
+
+
+    def _reranked_rows (self, queries:np.ndarray, shortlist:int, block_rows:int, limit:int) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Two stage search: shortlists the references closest to each query by their coarse hashes, block by block,
+        then returns the rows of the two shortlisted references closest by the full hashes, and their distances ((n, 2) matrices).
+        Distances beyond 'limit' are not exact (see '_pruned_distances').
+        """
+        coarse_queries = self.coarse (queries)
+        candidate_rows = np.zeros ((len (queries), 0), dtype=np.int64)
+        candidate_distances = np.zeros ((len (queries), 0), dtype=np.uint8)
+        for start in range (0, len (self.ids), block_rows):
+            distances = np.bitwise_count (np.bitwise_xor (self.coarse_hashes[None, start:start + block_rows], coarse_queries[:, None]))
+            rows = np.broadcast_to (np.arange (start, start + distances.shape[1]), distances.shape)
+            candidate_distances = np.concatenate ((candidate_distances, distances), axis=1)
+            candidate_rows = np.concatenate ((candidate_rows, rows), axis=1)
+            if (candidate_rows.shape[1] > shortlist):
+                kept = np.argpartition (candidate_distances, shortlist - 1, axis=1)[:, :shortlist]
+                candidate_distances = np.take_along_axis (candidate_distances, kept, axis=1)
+                candidate_rows = np.take_along_axis (candidate_rows, kept, axis=1)
+        return self._two_closest (candidate_rows, self._pruned_distances (self.hashes[candidate_rows], queries, limit))
+
+
+    def _pruned_distances (self, candidates:np.ndarray, queries:np.ndarray, limit:int) -> np.ndarray:
+        """
+        Distances between each query and its (n, k, words) candidates, summed 'prune_words' words at a time. Stops as soon as every
+        partial distance exceeds 'limit': the remaining words cannot bring any candidate back within it, and the partial distances
+        are returned instead (no match). Only the rerank stops early: the coarse pass before it costs the same with or without a match.
+        """
+        distances = np.zeros (candidates.shape[:2], dtype=np.uint32)
+        for word in range (0, candidates.shape[2], self.prune_words):
+            distances += np.bitwise_count (np.bitwise_xor (candidates[:, :, word:word + self.prune_words],
+                                                           queries[:, None, word:word + self.prune_words])).sum (axis=2, dtype=np.uint32)
+            if (not (distances <= limit).any ()):
+                break
+        return distances
+
+
+    @classmethod
+    def _merged_rows (cls, rows:np.ndarray, distances:np.ndarray, other_rows:np.ndarray, other_distances:np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Merges two searches ((n, 2) matrices of rows and distances): returns the two closest distinct references of each query.
+        """
+        duplicates = (other_rows[:, :, None] == rows[:, None, :]).any (axis=2)
+        other_distances = np.where (duplicates, np.iinfo (np.uint32).max, other_distances)
+        return cls._two_closest (np.concatenate ((rows, other_rows), axis=1), np.concatenate ((distances, other_distances), axis=1))
+
+
+    @staticmethod
+    def _two_closest (rows:np.ndarray, distances:np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the two smallest of each row of 'distances' (a (n, k) matrix), in order, and their 'rows'.
+        With a single column, the second ones are -1 rows at the maximal distance.
+        """
+        if (distances.shape[1] < 2):
+            return (np.concatenate ((rows, np.full_like (rows, -1)), axis=1),
+                    np.concatenate ((distances, np.full_like (distances, np.iinfo (np.uint32).max)), axis=1))
+        closest = np.argpartition (distances, 1, axis=1)[:, :2] # The second one is in place, after the first
+        return np.take_along_axis (rows, closest, axis=1), np.take_along_axis (distances, closest, axis=1)
@@ -1,26 +1,40 @@
-import time
 import numpy
 
 import cv2
 
 from inputimage import InputImage
+from metrics import metrics
 
 class PreProcessor:
+    """
+    Pre processing shared by every image: resizing, then CLAHE equalization of the grayscale image
+    (the thresholding and hashing input) and, only if needed, of the lightness of the color image.
+    Intermediate images are kept in buffers reused from one image to the next (not thread safe).
+    """
+    max_size : int = 311 #936
+    """ Longest side of pre processed images """
     verbose : bool
+    color : bool
+    """ Whether to equalize the color image too (only needed by color thresholding) """
     
-    def __init__(self, verbose:bool=False):
+    _resized : numpy.ndarray = None
+    _lab : numpy.ndarray = None
+    _lightness : numpy.ndarray = None
+    
+    def __init__(self, verbose:bool=False, color:bool=True):
         self.verbose = verbose
+        self.color = color
 
 
-    def pre_process_image(self, image:InputImage, clahe, max_size:int=311): #936
+    @metrics.timed('preprocess')
+    def pre_process_image(self, image:InputImage, clahe, max_size:int=max_size):
         '''
-        Pre process test and reference images for matching
+        Pre process test and reference images for matching. Returns the BGR image (equalized in color mode),
+        and also sets the equalized grayscale image of an InputImage.
         '''
         if (self.verbose):
             print("\tPre processing...")
 
-        start_time = time.time() # Performance stats
-
         if (type(image) == InputImage):
             preprocessed_image = image.raw_image # Result image
         else:
@@ -32,18 +46,27 @@ class PreProcessor:
         if longest_side > max_size:
             scale_factor = max_size / longest_side
             shape_scaled = (int(image_shape[1]*scale_factor), int(image_shape[0]*scale_factor))
-            preprocessed_image = cv2.resize(preprocessed_image, shape_scaled)
+            if (self.color):
+                preprocessed_image = self._resized = cv2.resize(preprocessed_image, shape_scaled, dst=self._resized) # Only an intermediate image
+            else:
+                preprocessed_image = cv2.resize(preprocessed_image, shape_scaled)
             if (self.verbose):
                 print("\t\tResizing to " + str(shape_scaled[0]) + "x" + str(shape_scaled[1]))
 
-        # Histogram equalization (CLAHE)
-        lab = cv2.cvtColor(preprocessed_image, cv2.COLOR_BGR2LAB)    # Conversion to LAB color space (lightness, redness, yellowness)
-        lab[...,0] = clahe.apply(lab[...,0])                         # Apply CLAHE to lightness plane
-        preprocessed_image = cv2.cvtColor(lab, cv2.COLOR_LAB2BGR)    # Conversion back to BGR color space used by cv2 (blue, green, red)
+        # Histogram equalization (CLAHE) of the grayscale image, computed once for thresholding and hashing
+        gray_image = cv2.cvtColor(preprocessed_image, cv2.COLOR_BGR2GRAY)
+        clahe.apply(gray_image, dst=gray_image)
+
+        # Histogram equalization (CLAHE) of the color image, in the reused buffers
+        if (self.color):
+            self._lab = cv2.cvtColor(preprocessed_image, cv2.COLOR_BGR2LAB, dst=self._lab)    # Conversion to LAB color space (lightness, redness, yellowness)
+            self._lightness = cv2.extractChannel(self._lab, 0, dst=self._lightness)           # Lightness plane
+            clahe.apply(self._lightness, dst=self._lightness)                                 # Apply CLAHE to lightness plane
+            cv2.insertChannel(self._lightness, self._lab, 0)
+            preprocessed_image = cv2.cvtColor(self._lab, cv2.COLOR_LAB2BGR)                   # Conversion back to BGR color space used by cv2 (blue, green, red)
 
         if (type(image) == InputImage):
             image.preprocessed_image = preprocessed_image
+            image.gray_image = gray_image
 
-        if (self.verbose):
-            exec_time = time.time() - start_time
-            print(f"\t\tDone in {round (exec_time, 5)} s")
+        return preprocessed_image
@@ -1,18 +1,26 @@
+import io
 import json
 import traceback
 import time
 import os
-import sys
-import urllib
+import urllib.request
 import requests
 import pickle
 
+import numpy as np
+
+from phashindex import PHashIndex
+from multiindex import MultiIndex
+from referenceimage import ReferenceImage
+from metrics import metrics
+
 class ReaderWriter:
     scryfall_bulks_url:str = 'https://api.scryfall.com/bulk-data'
     phash_filename:str = './data/phash.json'
     local_data_filename:str = './data/cards_data.json'
     local_bulk_filename:str = './data/cards_bulk.json'
-    tree_filename:str = './data/tree'
+    index_filename:str = './data/phash.idx'
+    manifest_filename:str = './data/manifest.json'
     
     verbose:bool
     
@@ -29,70 +37,158 @@ class ReaderWriter:
             return {}
     def get_online_data (self, bulk):
         return self._try_read_online_json (bulk['download_uri'], "data")
-    def get_tree (self):
+    def iter_online_data (self, bulk):
+        return self._iter_online_json_array (bulk['download_uri'], "data")
+    def get_index (self):
         if (self.verbose):
-            print (f"\tRetrieving tree...")
-            start_time = time.time ()
+            print (f"\tRetrieving index...")
         try:
-            with open (self.tree_filename, "rb") as file:
-                data = file.read (data)
+            with metrics.span ('index.load'):
+                index = PHashIndex.load (self.index_filename)
+            if (index.hash_bits != ReferenceImage.hash_size ** 2):
+                raise ValueError ("Outdated pHash index", index.hash_bits)
             if (self.verbose):
-                exec_time = time.time () - start_time
-                print (f"\t\tRetrieved {sys.getsizeof (data)} bytes in {round (exec_time, 5)} s.")
-        except FileNotFoundError:
-            data = {}
+                print (f"\t\tMapped {len (index)} references.")
+        except (FileNotFoundError, ValueError):
+            index = None
             if (self.verbose):
-                print (f"\t\tFailed to retrieve tree.")
-        return data
+                print (f"\t\tFailed to retrieve index at {self.index_filename}.")
+        return index
     def get_local_bulk (self):
         return self._try_read_local_json (self.local_bulk_filename, "bulk")
     def get_local_data (self):
         return self._try_read_local_json (self.local_data_filename, "data")
     def get_references (self):
         return self._try_read_local_json (self.phash_filename, "references")
+    def get_manifest (self):
+        return self._try_read_local_json (self.manifest_filename, "manifest")
+    def get_references_mtime (self):
+        """
+        Modification time (ns) of the references loaded by the scanner: the index, else the json references. None if there are none.
+        """
+        for filename in (self.index_filename, self.phash_filename):
+            try:
+                return os.stat (filename).st_mtime_ns
+            except FileNotFoundError:
+                continue
+        return None
     
 
-    def write_tree (self, data):
+    def write_index (self, index:PHashIndex):
         if (self.verbose):
-            print (f"\tWriting tree...")
-            start_time = time.time ()
-        with open (self.tree_filename, "wb") as file:
-            file.write (data)
+            print (f"\tWriting index...")
+        with metrics.span ('index.write'):
+            index.write (self.index_filename)
         if (self.verbose):
-            exec_time = time.time () - start_time
-            print (f"\t\tWrote {sys.getsizeof (data)} bytes in {round (exec_time, 5)} s.")
+            print (f"\t\tWrote {len (index)} references.")
+        return True
     def write_bulk (self, bulk):
         return self._try_write_json (bulk, self.local_bulk_filename, "bulk")
     def write_data (self, data):
         return self._try_write_json (data, self.local_data_filename, "data")     
     def write_references (self, references):
         return self._try_write_json (references, self.phash_filename, "references")
+    def open_data (self):
+        return JsonArrayWriter (self.local_data_filename, self.verbose)
+    def open_references (self, partial:bool=False, multi_index:bool=False):
+        return ReferencesWriter (self.phash_filename, self.index_filename, self.verbose, partial, multi_index)
+    def write_manifest (self, manifest):
+        return self._try_write_json (manifest, self.manifest_filename, "manifest")
     
     
     def _try_read_online_json (self, uri, name):
         if (self.verbose):
             print (f"\tRetrieving online {name}...")
-            start_time = time.time ()
         time.sleep (0.1) # 100ms delay for good citizenship
-        with urllib.request.urlopen (uri) as url:
+        with metrics.span ('json.download'), urllib.request.urlopen (uri) as url:
             json_data = json.load (url)
         if (self.verbose):
-            exec_time = time.time () - start_time
-            count = sum (1 for c in json_data)
-            print (f"\t\tRetrieved {count} items ({sys.getsizeof (json_data)} bytes) in {round (exec_time, 5)} s.")
+            print (f"\t\tRetrieved {len (json_data)} items.")
         return json_data
     
+    def _iter_online_json_array (self, uri, name, chunk_size:int=1 << 20):
+        """
+        Yields the items of an online json array one at a time, without loading the whole document.
+        Also works with 'file://' uris.
+        """
+        if (self.verbose):
+            print (f"\tStreaming online {name}...")
+        time.sleep (0.1) # 100ms delay for good citizenship
+        count = 0
+        with urllib.request.urlopen (uri) as url:
+            for item in self._iter_json_array (io.TextIOWrapper (url, encoding='utf-8'), chunk_size):
+                count += 1
+                yield item
+        metrics.count ('json.stream.items', count)
+        if (self.verbose):
+            print (f"\t\tStreamed {count} items.")
+    
+    def _iter_json_array (self, file, chunk_size:int=1 << 20):
+        """
+        Incrementally decodes a json array from a text file, reading it by chunks.
+        An item is only yielded once the separator following it (',' or ']') is read, since an item cut by the end of a chunk
+        may still decode (ex. a number). Raises ValueError if the array is malformed (ex. a missing or duplicated comma).
+        """
+        decoder = json.JSONDecoder ()
+        buffer = ''
+        position = 0
+        eof = False
+        expected = '[' # Then 'first value' (or ']'), then 'value' after each ','
+        while True:
+            # Skips whitespaces
+            while position < len (buffer) and buffer[position].isspace ():
+                position += 1
+            if position < len (buffer):
+                char = buffer[position]
+                if expected == '[':
+                    if char != '[':
+                        raise ValueError ("Expected a json array")
+                    expected = 'first value'
+                    position += 1
+                    continue
+                if expected == 'first value' and char == ']':
+                    return
+                if char in ',]':
+                    raise ValueError ("Expected a json value", char)
+                # Decodes the item, then looks for its separator (reading more data if it is missing)
+                try:
+                    item, end = decoder.raw_decode (buffer, position)
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                    end = None # Item cut by the end of the buffer
+                if (end is not None):
+                    # Number characters right after the item up to the end of the buffer may be the rest of a cut number (ex. '1.' decodes as 1)
+                    cut = end
+                    while cut < len (buffer) and buffer[cut] in '0123456789+-.eE':
+                        cut += 1
+                    while end < len (buffer) and buffer[end].isspace ():
+                        end += 1
+                    if (end < len (buffer) and (cut < len (buffer) or eof)):
+                        if buffer[end] not in ',]':
+                            raise ValueError ("Expected ',' or ']' after a json array item", buffer[end])
+                        yield item
+                        if buffer[end] == ']':
+                            return
+                        position = end + 1
+                        expected = 'value'
+                        continue
+            if eof:
+                raise ValueError ("Unterminated json array")
+            # Reads more data
+            chunk = file.read (chunk_size)
+            eof = (chunk == '')
+            buffer = buffer[position:] + chunk
+            position = 0
+    
     def _try_read_local_json (self, filename, name):
         if (self.verbose):
             print (f"\tRetrieving local {name}...")
-            start_time = time.time ()
         try:
-            with open (filename, 'r', encoding='utf-8') as file:
+            with metrics.span ('json.read'), open (filename, 'r', encoding='utf-8') as file:
                 json_data = json.load (file)
             if (self.verbose):
-                exec_time = time.time () - start_time
-                count = sum (1 for c in json_data)
-                print (f"\t\tRetrieved {count} items ({sys.getsizeof (json_data)} bytes) in {round (exec_time, 5)} s.")
+                print (f"\t\tRetrieved {len (json_data)} items.")
         except FileNotFoundError:
             json_data = {}
             if (self.verbose):
@@ -107,4 +203,86 @@ class ReaderWriter:
             json.dump (json_data, file, ensure_ascii=False)
         if (self.verbose):
             print (f"\tWrote {name}.")
-        return True
\ No newline at end of file
+        return True
+
+
+class JsonArrayWriter:
+    """
+    Streams items to a json array file. The file is written aside and renamed on close.
+    If the block raises, the file written aside is discarded and the previous file is kept, unless 'partial'.
+    """
+    verbose:bool
+    filename:str
+    count:int
+    partial:bool = False
+    """ Whether the items written before an exception still replace the previous file """
+    
+    def __init__ (self, filename:str, verbose:bool=False):
+        self.filename = filename
+        self.verbose = verbose
+        self.count = 0
+        self._file = None
+    
+    def __enter__ (self):
+        os.makedirs (os.path.dirname (self.filename), exist_ok=True)
+        self._file = open (self.filename + '.tmp', 'w', encoding='utf-8')
+        self._file.write ('[')
+        return self
+    
+    def write (self, item):
+        if (self.count > 0):
+            self._file.write (', ')
+        json.dump (item, self._file, ensure_ascii=False)
+        self.count += 1
+    
+    def __exit__ (self, exc_type, exc_value, exc_traceback):
+        if (exc_type is not None and not self.partial):
+            self._file.close ()
+            os.remove (self.filename + '.tmp')
+            if (self.verbose):
+                print (f"\tFailed to write {self.filename}, kept the previous one.")
+            return False
+        self._file.write (']')
+        self._file.close ()
+        os.replace (self.filename + '.tmp', self.filename)
+        if (self.verbose):
+            print (f"\tWrote {self.count} items to {self.filename}.")
+        return False
+
+
+class ReferencesWriter (JsonArrayWriter):
+    """
+    Streams references to the json references file as they are computed, then writes the matching index on close.
+    Only the packed hashes are kept in memory. With 'partial', the references written before an exception are still saved.
+    """
+    index_filename:str
+    multi_index:bool
+    """ Whether the index also stores multi-index hashing tables (near duplicate matching) """
+    
+    def __init__ (self, phash_filename:str, index_filename:str, verbose:bool=False, partial:bool=False, multi_index:bool=False):
+        super ().__init__ (phash_filename, verbose)
+        self.index_filename = index_filename
+        self.partial = partial
+        self.multi_index = multi_index
+        self._ids = []
+        self._hashes = []
+    
+    def write (self, reference):
+        hash = PHashIndex.decode (reference['phash'], ReferenceImage.hash_size ** 2) # Validates the reference before writing it
+        super ().write (reference)
+        self._ids.append (reference['id'])
+        self._hashes.append (hash)
+    
+    def __exit__ (self, exc_type, exc_value, exc_traceback):
+        super ().__exit__ (exc_type, exc_value, exc_traceback)
+        if (exc_type is not None and not self.partial):
+            return False # The previous references and index are kept
+        hash_bits = ReferenceImage.hash_size ** 2
+        hashes = np.array (self._hashes, dtype=np.uint64).reshape (len (self._hashes), -(-hash_bits // 64))
+        try:
+            PHashIndex (self._ids, hashes, hash_bits, MultiIndex.build (hashes) if self.multi_index else None).write (self.index_filename)
+        except Exception:
+            if (exc_type is None):
+                raise
+            traceback.print_exc () # Does not mask the exception of the block
+        return False
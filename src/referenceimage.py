@@ -1,9 +1,15 @@
-from imagehash import ImageHash
+from phasher import PHasher
 import json
 
 class ReferenceImage:
+    hash_size:int = PHasher.hash_size
+    """ pHash size of the references (hash_size x hash_size bits) """
+    phash_format:dict = {'hasher': 'PHasher', 'hash_size': hash_size, 'highfreq_factor': PHasher.highfreq_factor, 'encoding': 'base64 packed uint64', 'version': 1}
+    """ How the phashes are computed and encoded (bump 'version' on any change): stored phashes of another format are not reused """
+    
     id:str
     phash:str
+    """ Packed pHash, base64 encoded (see PHashIndex.encode) """
     
     def __init__ (self, id:str, phash:str):
         self.id = id
@@ -1,102 +1,229 @@
 import sys
-import urllib.request
 from requests import get
 from json import loads
 import json
-import time
 import traceback
-import imagehash
-from PIL import Image as PILImage
 import cv2 as cv
 import numpy as np
-import matplotlib.pyplot as plt
 import os
 from collections import defaultdict
-import vptree
+from itertools import groupby
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 from referenceimage import ReferenceImage
 from readerwriter import ReaderWriter
-from utils import binary_array_to_dec
+from downloader import Downloader
+from imagecache import ImageCache
+from phashindex import PHashIndex
+from phasher import PHasher
+from utils import bounded_map
+from metrics import metrics
+
+
+_phasher = PHasher (ReferenceImage.hash_size)
+""" Hasher of a hashing process """
+
+def compute_ref_phash (content:bytes) -> str:
+    """
+    Computes the reference phash of a JPEG card image, in its json form.
+    The image is decoded straight to grayscale uint8, the hash input of the scanner, and hashed the same way.
+    """
+    image = cv.imdecode (np.frombuffer (content, dtype=np.uint8), cv.IMREAD_GRAYSCALE)
+    if (image is None):
+        raise ValueError ("Undecodable image")
+    # TODO: add clahe to card_images ?
+    return PHashIndex.encode (_phasher.hash (image))
+
+
+def _compute_ref_phash_job (job):
+    """
+    Hashing stage job: (key, image content or cached image path or None) -> (key, phash or None).
+    """
+    key, source = job
+    try:
+        if isinstance (source, str):
+            with open (source, 'rb') as file:
+                source = file.read ()
+        return (key, None if source is None else compute_ref_phash (source))
+    except Exception:
+        traceback.print_exc ()
+        return (key, None)
+
 
 class Save:
     
     verbose:bool
     rw:ReaderWriter
+    downloader:Downloader
+    cache:ImageCache
+    hash_workers:int
+    multi_index:bool
+    """ Whether the index also stores multi-index hashing tables (near duplicate matching) """
     
-    def __init__ (self, verbose:bool):
+    def __init__ (self, verbose:bool, workers:int=8, rate_limit:float=0., cache_size:int=16 * 2**30, hash_workers:int=None, multi_index:bool=False):
         self.verbose = verbose
+        self.hash_workers = hash_workers or os.cpu_count () or 1
+        self.multi_index = multi_index
         self.rw = ReaderWriter (verbose)
+        self.downloader = Downloader (workers, rate_limit, verbose=verbose)
+        self.cache = ImageCache (max_bytes=cache_size, verbose=verbose)
+        if (verbose):
+            metrics.enable (trace=True) # Traces every stage
         
     
-    def update_ref_phash (self, force_update_data:bool=False):
+    def close (self):
+        """
+        Releases the network resources (the download session).
+        """
+        self.downloader.close ()
+        
+    
+    @metrics.timed ('save.references')
+    def update_ref_phash (self, force_update_data:bool=False, incremental:bool=False, from_cache:bool=False):
         print ("Updating phashes...")
         
         local_data = self.rw.get_local_data ()
+        
+        # Cards without any usable image url are skipped (not hashed, nor recorded in the manifest)
+        usable_data = [card for card in local_data if self._card_image_urls (card)]
+        metrics.count ('save.skipped', len (local_data) - len (usable_data))
+        if (len (usable_data) < len (local_data)):
+            print (f"\tSkipping {len (local_data) - len (usable_data)} cards without image.")
+        local_data = usable_data
+        
+        # In incremental mode, only new or changed cards (according to the manifest of the previous run) are processed,
+        # unless the previous phashes were computed or encoded differently
+        manifest = self.rw.get_manifest () if incremental else {}
+        if (manifest.get ('format') != ReferenceImage.phash_format):
+            if (incremental):
+                print ("\tPhash format changed, rebuilding every reference.")
+            manifest, incremental = {}, False
+        else:
+            manifest = manifest['cards']
+        old_ref_images = defaultdict (list)
+        if (incremental):
+            for ref in self.rw.get_references ():
+                old_ref_images[ref['id']].append (ref)
+        updated_cards = [card for card in local_data
+                         if manifest.get (card['id']) != self._manifest_entry (card) or card['id'] not in old_ref_images]
+
+        updated_ids = set (card['id'] for card in updated_cards)
 
         if (self.verbose):
-            print ("\tComputing cards phashes...")
-        ref_images = []
+            print (f"\tComputing {len (updated_cards)} cards phashes...")
+        hashes = self._hash_from_cache (updated_cards) if from_cache else self._hash_online (updated_cards)
+        card_hashes = groupby (hashes, key=lambda result: result[0][:2]) # Results of each updated card, in order
+        computed_count, failed_count = 0, 0
         
-        # 'Try' block to write already processed cards to disk even in the event of a failure
-        try:
-            i = 0
+        # Patches the references while streaming them to disk: computed cards replace their previous phashes, unchanged cards keep theirs,
+        # removed cards are dropped. Cards are only recorded in the manifest once all their images are hashed, so that failures are retried
+        # on the next run. In the event of a failure, already processed and unchanged cards are still written.
+        new_manifest = {}
+        with self.rw.open_references (partial=True, multi_index=self.multi_index) as references:
             for card in local_data:
-                # Prints progress
-                if i % 5000 == 0:
-                    print (f"\t{i} / {len (local_data)}")
-                i += 1
-                
-                id = card['id'] # Scryfall id
-
-                # Retrieves the card image(s) URL(s). There can be multiple images if the card is multifaced.
-                if 'image_uris' in card:
-                    img_urls = card['image_uris']['normal']
-                elif 'card_faces' in card:
-                    img_urls = []
-                    for face in card['card_faces']:
-                        img_urls.append (face['image_uris']['normal'])
-                else:
-                    print (card)
-                    raise Exception
-                
-                # Retrieves the card image(s).
-                card_images = []
-                for url in img_urls:
-                    req = urllib.request.Request(url)
-                    # Connection can be reset or timeout unexpectedly and for unknown reasons. To counter this, each download has 10 tries.
-                    for j in range (0, 10): 
-                        try:
-                            response = urllib.request.urlopen (req, timeout=5)
-                            im = plt.imread (response, format='jpg')
-                            break
-                        except:
-                            response = None
-                            im = None
-                            pass
-                    if (im != None):
-                        card_images.append (im)
+                id = card['id']
+                results = None
+                if id in updated_ids and card_hashes is not None:
+                    try:
+                        (i, _), results = next (card_hashes)
+                        results = list (results)
+                    except:
+                        traceback.print_exc()
+                        card_hashes = None
+                        results = None
+                if results is not None:
+                    # Prints progress
+                    if i % 5000 == 0:
+                        print (f"\t{i} / {len (updated_cards)}")
+                    failed = False
+                    for (_, _, face), dec_phash in results:
+                        if (dec_phash is None):
+                            print (f"\t\tFailed to retrieve image {face} of card {id} !")
+                            failed = True
+                        else:
+                            references.write (ReferenceImage (id, dec_phash).toJSON ())
+                    if (failed):
+                        failed_count += 1
                     else:
-                        print (f"\t\tFailed to retrieve image at url {url} !")
-                
-                # TODO: add clahe to card_images ?
-                
-                # Computes each image's phash.
-                for image in card_images:
-                    phash = imagehash.phash (PILImage.fromarray (np.uint8 (255 * cv.cvtColor (image, cv.COLOR_BGR2RGB))), hash_size=4)
-                    dec_phash = binary_array_to_dec (phash.hash)
-                    ref_images.append (ReferenceImage (id, str (dec_phash)).toJSON ())
-        except:
-            traceback.print_exc()
+                        computed_count += 1
+                        new_manifest[id] = self._manifest_entry (card)
+                elif id in manifest and id in old_ref_images:
+                    for ref in old_ref_images[id]:
+                        references.write (ref)
+                    new_manifest[id] = manifest[id]
                 
+        metrics.count ('save.computed', computed_count)
+        metrics.count ('save.failed', failed_count)
+        metrics.count ('save.unchanged', len (local_data) - len (updated_cards))
         if (self.verbose):
-            print (f"\tComputed {sum (1 for c in local_data)} cards phashes.")
+            print (f"\tComputed {computed_count} cards phashes ({failed_count} failed, {len (local_data) - len (updated_cards)} unchanged, {len (set (manifest) - set (new_manifest))} removed or outdated).")
             
-        self.rw.write_references (ref_images)
+        self.rw.write_manifest ({'format': ReferenceImage.phash_format, 'cards': new_manifest})
+
+    
+    def _hash_online (self, cards):
+        """
+        Yields ((card index, Scryfall id, face index), phash) for each card image, in order, phash being None if the image could not be retrieved.
+        Two pipeline stages: images are read from the cache or downloaded (and cached) by a thread pool, then hashed by a process pool.
+        Each stage holds a bounded number of images in flight.
+        """
+        def load (job):
+            (i, id, face), url = job
+            content = self.cache.get (id, face, url)
+            if (content is None):
+                content = self.downloader.get (url)
+                if (content is not None):
+                    self.cache.put (id, face, url, content)
+            return ((i, id, face), content)
+        with ThreadPoolExecutor (max_workers=self.downloader.workers) as downloaders, ProcessPoolExecutor (max_workers=self.hash_workers) as hashers:
+            contents = bounded_map (downloaders, load, self._card_image_jobs (cards), 2 * self.downloader.workers)
+            yield from bounded_map (hashers, _compute_ref_phash_job, contents, 2 * self.hash_workers)
+    
+    
+    def _hash_from_cache (self, cards):
+        """
+        Same as '_hash_online', but only from cached images. Uncached images count as failures.
+        """
+        def cached_paths ():
+            for key, url in self._card_image_jobs (cards):
+                path = self.cache.path (key[1], key[2], url)
+                yield (key, path if os.path.exists (path) else None)
+        with ProcessPoolExecutor (max_workers=self.hash_workers) as hashers:
+            yield from bounded_map (hashers, _compute_ref_phash_job, cached_paths (), 2 * self.hash_workers)
+    
+    
+    def _card_image_urls (self, card):
+        """
+        Returns the card image(s) URL(s). There can be multiple images if the card is multifaced. Empty if an image is missing.
+        """
+        if 'image_uris' in card:
+            return [card['image_uris']['normal']] if 'normal' in card['image_uris'] else []
+        elif 'card_faces' in card and all ('normal' in face.get ('image_uris', {}) for face in card['card_faces']):
+            return [face['image_uris']['normal'] for face in card['card_faces']]
+        else:
+            return []
+    
+    
+    def _manifest_entry (self, card):
+        """
+        What the card's phashes depend on: an image change gives a new URL (Scryfall URLs carry a timestamp) or a new status.
+        """
+        return {'image_status': card.get ('image_status'), 'images': self._card_image_urls (card)}
+    
+    
+    def _card_image_jobs (self, cards):
+        """
+        Yields a ((card index, Scryfall id, face index), url) download job for each card image.
+        """
+        for i, card in enumerate (cards):
+            id = card['id'] # Scryfall id
+            for face, url in enumerate (self._card_image_urls (card)):
+                yield ((i, id, face), url)
                     
                
+    @metrics.timed ('save.cards')
     def update_cards (self, force:bool=False):
         print ("Updating cards...")
-        start_time = time.time ()
         
         # Retrieves local and online bulk data item for every unique card in English
         # These do NOT contains the actual cards
@@ -109,13 +236,30 @@ class Save:
                 print ("\tAlready up to date.")
                 return
 
-        # Downloads cards data (the actual cards)
-        online_data = self.rw.get_online_data (online_bulk)
-            
-        # Filters out uninteresting cards
-        filtered_online_data = []
+        # Streams cards data (the actual cards) through the filters to disk, one card at a time
         verbose_filter_stats = defaultdict (int)
-        for card in online_data:
+        online_data = self.rw.iter_online_data (online_bulk)
+        kept_cards = self._deduplicate_cards (self._filter_cards (online_data, verbose_filter_stats), verbose_filter_stats)
+        with self.rw.open_data () as data:
+            for card in kept_cards:
+                data.write (card)
+          
+        if (self.verbose):
+            for stat in list (verbose_filter_stats):
+                print(f"\tRemoved {verbose_filter_stats[stat]} cards ({stat}).")
+            print (f"\tKeeping {data.count} cards.")
+            
+        # Writes 'bulk infos' to disk once the data is complete
+        self.rw.write_bulk (online_bulk)
+        
+        return
+    
+    
+    def _filter_cards (self, cards, verbose_filter_stats):
+        """
+        Filters out uninteresting cards from a stream of cards.
+        """
+        for card in cards:
             # Only keeps english and french cards
             if card['lang'] != 'en' and card['lang'] != 'fr':
                 continue
@@ -142,53 +286,35 @@ class Save:
                 verbose_filter_stats[f'missing_img[{lang}]'] += 1
                 continue
             # Adds card
-            filtered_online_data.append (card)
-            
-        # Groups cards with the same name
-        unique_name_cards = {}
-        for card in filtered_online_data:
-            if card['name'] in unique_name_cards:
-                unique_name_cards[card['name']].append (card)
-            else:
-                unique_name_cards[card['name']] = [card]
-        
-        # Only keeps cards who are not nearly-identical to an other card with the same name (for ex., eliminate all but 1 generic same-looking Sol Ring)
-        kept_cards = []
-        for name in unique_name_cards:
-            same_name_cards = unique_name_cards[name]
-            ok_cards = []
-            for card in same_name_cards:
-                ok = True
-                for ok_card in ok_cards:
-                    # A card is discarded if it meets all of the following criterias (or if it is from The List):
-                    if ((ok_card['frame'] == card['frame'] and # Same frame
-                         ok_card['full_art'] == card['full_art'] and # Both (not) full art
-                         ok_card['border_color'] == card['border_color'] and # Same bord color (white, back, ...)
-                         ok_card['textless'] == card['textless'] and # Both (not) textless
-                         (('watermark' not in ok_card and 'watermark' not in card) or ('watermark' in ok_card and 'watermark' in card and ok_card['watermark'] == card['watermark'])) and # Same watermarks
-                         (('frame_effects' not in ok_card and 'frame_effects' not in card) or ('frame_effects' in ok_card and 'frame_effects' in card and ok_card['frame_effects'] == card['frame_effects'])) and # Same frame effects
-                         ('illustration_id' in ok_card and 'illustration_id' in card and ok_card['illustration_id'] == card['illustration_id']) and # Same illustration
-                         card['set_type'] != 'promo' and # Not a promo card
-                         card['variation'] != True) # Not a variation of an other card
-                        or (card['set'] == 'plst' or card['set'] == 'ulst')
-                        ):
-                        verbose_filter_stats[f'identical[{lang}]'] += 1
-                        ok = False
-                        break
-                if (ok):
-                    ok_cards.append (card)
-                    kept_cards.append (card)
-          
-        if (self.verbose):
-            for stat in list (verbose_filter_stats):
-                print(f"\tRemoved {verbose_filter_stats[stat]} cards ({stat}).")
-            print (f"\tKeeping {len(kept_cards)} cards.")
-            
-        # Writes 'bulk infos' and 'data' JSONs to disk
-        self.rw.write_bulk (online_bulk)
-        self.rw.write_data (kept_cards)
-        
-        exec_time = time.time () - start_time
-        print(f"\t\tDone in {round (exec_time, 5)} s")
-        
-        return
+            yield card
+    
+    
+    def _deduplicate_cards (self, cards, verbose_filter_stats):
+        """
+        Only keeps cards who are not nearly-identical to an other card with the same name (for ex., eliminate all but 1 generic same-looking Sol Ring)
+        from a stream of cards. Only the compared fields of already kept cards are remembered.
+        """
+        compared_fields = ('frame', 'full_art', 'border_color', 'textless', 'watermark', 'frame_effects', 'illustration_id')
+        ok_cards_by_name = defaultdict (list)
+        for card in cards:
+            ok_cards = ok_cards_by_name[card['name']]
+            ok = True
+            for ok_card in ok_cards:
+                # A card is discarded if it meets all of the following criterias (or if it is from The List):
+                if ((ok_card['frame'] == card['frame'] and # Same frame
+                     ok_card['full_art'] == card['full_art'] and # Both (not) full art
+                     ok_card['border_color'] == card['border_color'] and # Same bord color (white, back, ...)
+                     ok_card['textless'] == card['textless'] and # Both (not) textless
+                     (('watermark' not in ok_card and 'watermark' not in card) or ('watermark' in ok_card and 'watermark' in card and ok_card['watermark'] == card['watermark'])) and # Same watermarks
+                     (('frame_effects' not in ok_card and 'frame_effects' not in card) or ('frame_effects' in ok_card and 'frame_effects' in card and ok_card['frame_effects'] == card['frame_effects'])) and # Same frame effects
+                     ('illustration_id' in ok_card and 'illustration_id' in card and ok_card['illustration_id'] == card['illustration_id']) and # Same illustration
+                     card['set_type'] != 'promo' and # Not a promo card
+                     card['variation'] != True) # Not a variation of an other card
+                    or (card['set'] == 'plst' or card['set'] == 'ulst')
+                    ):
+                    verbose_filter_stats[f"identical[{card['lang']}]"] += 1
+                    ok = False
+                    break
+            if (ok):
+                ok_cards.append ({field: card[field] for field in compared_fields if field in card})
+                yield card
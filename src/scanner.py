@@ -1,42 +1,89 @@
 import numpy as np
-import matplotlib.pyplot as plt
 import cv2 as cv
-import imagehash
-from PIL import Image as PILImage
-import json
+import os
 import time
-import statistics
-import vptree
+import traceback
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 from inputimage import InputImage
-from referenceimage import ReferenceImage
 from preprocessor import PreProcessor
 from readerwriter import ReaderWriter
+from phashindex import PHashIndex
+from phasher import PHasher
+from metrics import metrics
 from segmenter import Segmenter, Thresholding
-from utils import _convex_hull_polygon, _get_bounding_quad, four_point_transform, binary_array_to_dec
+from utils import bounded_map, imread_reduced, imdecode_reduced
+
+
+_worker_scanner = None
+""" Scanner of a 'scan_batch' worker process """
+
+def _init_scan_worker (verbose:bool, multi:bool, track_roi:bool, index:PHashIndex, max_distance:float, record_metrics:bool):
+    global _worker_scanner
+    metrics.reset () # Metrics of the main process, if forked
+    if (record_metrics):
+        metrics.enable ()
+    _worker_scanner = Scanner (verbose, multi, track_roi, index, max_distance)
+
+def _scan_worker (image):
+    """
+    Returns (id, seconds, metrics recorded while scanning the image or None), the metrics to be merged by the main process.
+    """
+    id, elapsed = _worker_scanner.scan_timed (image)
+    return (id, elapsed, metrics.collect () if metrics.enabled else None)
+
+def _read_image_timed (image):
+    """
+    Reads an image path (arrays are passed through). Returns (image or None, seconds).
+    """
+    start_time = time.perf_counter ()
+    if isinstance (image, str):
+        image = imread_reduced (image, PreProcessor.max_size)
+    return (image, time.perf_counter () - start_time)
+
 
 class Scanner:
     verbose : bool
+    multi : bool
+    """ Whether to find every card of an image ('scan_all') instead of one """
     rw:ReaderWriter
     pp:PreProcessor
     seg:Segmenter
+    phasher:PHasher
     clahe=None
-    tree=None
+    index:PHashIndex=None
+    index_mtime:int=None
+    """ Modification time of the references the index was built from """
+    static_index:bool=False
+    """ Whether the index was given to the scanner (ex. built in memory) instead of loaded from the references, and is never reloaded """
+    max_distance:float = 0.42
+    """ Maximum Hamming distance of a match, relative to the hash size: farther cards (blank frames, cards missing from the references) get no match (None) """
     
-    def __init__ (self, verbose:bool=False):
+    def __init__ (self, verbose:bool=False, multi:bool=False, track_roi:bool=False, index:PHashIndex=None, max_distance:float=None):
         self.rw = ReaderWriter (verbose)
-        self.pp = PreProcessor (verbose)
-        self.seg = Segmenter (Thresholding.ADAPTATIVE, verbose)
+        self.pp = PreProcessor (verbose, color=False) # Adaptative thresholding and hashing only need the grayscale image
+        self.seg = Segmenter (Thresholding.ADAPTATIVE, verbose, track_roi)
+        self.phasher = PHasher ()
         self.clahe = cv.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
         self.verbose = verbose
+        self.multi = multi
+        if (max_distance is not None):
+            self.max_distance = max_distance
+        if (verbose):
+            metrics.enable (trace=True) # Traces every stage
         
-        self.build_tree ()
+        if (index is None):
+            self.build_index ()
+        else:
+            self.index = index
+            self.static_index = True
     
     
+    @metrics.timed ('scan')
     def scan (self, img:np.ndarray):
-        print ("Recognizing card...")     
-        
-        start_time = time.time() 
+        if (self.verbose):
+            print ("Recognizing card...")
         
         # Creates test image object
         input_img_obj = InputImage (img)
@@ -53,58 +100,221 @@ class Scanner:
         # Compares pHash
         id = self.compare_phash (phash)
         
-        if (self.verbose):
-            exec_time = time.time() - start_time
-            print(f"\tDone in {round (exec_time, 5)} s")
-
         return id
     
     
-    def computes_phash (self, image):
+    @metrics.timed ('scan_all')
+    def scan_all (self, img:np.ndarray):
+        """
+        Identifies every card of the image. Returns their ids (largest card first).
+        """
         if (self.verbose):
-            start_time = time.time()
-            print("\tComputing phash...")
-        phash = imagehash.phash_simple (PILImage.fromarray (np.uint8 (255 * cv.cvtColor (image, cv.COLOR_BGR2RGB))), hash_size=32)
-        binary_phash = phash.hash
-        if (self.verbose):
-            exec_time = time.time() - start_time
-            print(f"\t\tDone in {round (exec_time, 5)} s")
-        return binary_phash.flatten ()
+            print ("Recognizing cards...")
+        
+        # Creates test image object
+        input_img_obj = InputImage (img)
+        
+        # Pre-process raw image
+        self.pp.pre_process_image (input_img_obj, self.clahe)
+        
+        # Gets every card from pre-processed image
+        candidates = self.seg.segment_all (input_img_obj)
+        
+        # Computes and compares pHashes together
+        phashes = self.computes_phashes ([candidate.image for candidate in candidates])
+        ids = self.compare_phashes (phashes)
+        
+        return ids
+    
+    
+    def scan_safe (self, image):
+        """
+        Scans an image, image path or encoded image ('scan_all' in multi mode). Returns None if the image could not be read or scanned.
+        """
+        try:
+            image = self._read_image (image)
+            return self.scan_all (image) if self.multi else self.scan (image)
+        except Exception:
+            traceback.print_exc ()
+            return None
+    
+    
+    def scan_many (self, images):
+        """
+        Scans images, image paths or encoded images together: each one is pre processed and segmented on its own, then
+        all their cards are hashed and matched in one batch. Returns their ids (lists of ids in multi mode), None for
+        images that could not be read or scanned.
+        """
+        results = [None] * len (images)
+        card_images, owners = [], []
+        for i, image in enumerate (images):
+            try:
+                input_img_obj = InputImage (self._read_image (image))
+                self.pp.pre_process_image (input_img_obj, self.clahe)
+                if (self.multi):
+                    images_cards = [candidate.image for candidate in self.seg.segment_all (input_img_obj)]
+                    results[i] = []
+                else:
+                    self.seg.segment (input_img_obj)
+                    images_cards = [input_img_obj.card_image]
+            except Exception:
+                traceback.print_exc ()
+                continue
+            for card_image in images_cards:
+                if (card_image.size > 0):
+                    card_images.append (card_image)
+                    owners.append (i)
+        
+        # Computes and compares pHashes together
+        ids = self.compare_phashes (self.computes_phashes (card_images))
+        for i, id in zip (owners, ids):
+            if (self.multi):
+                results[i].append (id)
+            else:
+                results[i] = id
+        metrics.count ('scan.images', len (images))
+        metrics.count ('scan.failures', sum (1 for result in results if result is None))
+        return results
+    
+    
+    def scan_timed (self, image, elapsed:float=0.):
+        """
+        Same as 'scan_safe', returns (id, seconds spent reading and scanning the image).
+        """
+        start_time = time.perf_counter ()
+        id = self.scan_safe (image)
+        return (id, elapsed + time.perf_counter () - start_time)
+    
+    
+    def scan_batch (self, images, workers:int=None, prefetch:int=None):
+        """
+        Scans a (possibly lazy) iterable of images or image paths with a pool of worker processes, each holding its own
+        scanner over the memory-mapped index. Yields ids in submission order (None for failed scans).
+        """
+        for id, _ in self._scan_batch_timed (images, workers, prefetch):
+            yield id
+    
+    
+    def scan_stream (self, images, workers:int=None, prefetch:int=None):
+        """
+        Same as 'scan_batch', but yields a {'path', 'id', 'time'} record for each image as soon as it is scanned.
+        Images are read lazily, at most 'prefetch' ahead, so memory stays bounded whatever the number of images.
+        """
+        def with_paths ():
+            for image in images:
+                paths.append (image if isinstance (image, str) else None)
+                yield image
+        paths = deque ()
+        for id, elapsed in self._scan_batch_timed (with_paths (), workers, prefetch):
+            yield {'path': paths.popleft (), 'id': id, 'time': round (elapsed, 5)}
+    
+    
+    def _scan_batch_timed (self, images, workers:int=None, prefetch:int=None):
+        workers = workers or os.cpu_count () or 1
+        prefetch = max (prefetch or 2 * workers, workers)
+        for id, elapsed in self._scan_batch_results (images, workers, prefetch):
+            # Recorded in this process, whichever process scanned the image
+            metrics.observe ('scan.image', int (elapsed * 1e9))
+            metrics.count ('scan.images')
+            if (id is None):
+                metrics.count ('scan.failures')
+            yield id, elapsed
+    
+    
+    def _scan_batch_results (self, images, workers:int, prefetch:int):
+        if (workers == 1):
+            # Reads images ahead in a thread while scanning in this process
+            with ThreadPoolExecutor (max_workers=1) as reader:
+                for image, elapsed in bounded_map (reader, _read_image_timed, images, prefetch):
+                    yield self.scan_timed (image, elapsed)
+            return
+        with ProcessPoolExecutor (max_workers=workers, initializer=_init_scan_worker, initargs=(self.verbose, self.multi, self.seg.track_roi, self.index if self.static_index else None, self.max_distance, metrics.enabled)) as executor:
+            for id, elapsed, worker_metrics in bounded_map (executor, _scan_worker, images, prefetch):
+                if (worker_metrics is not None):
+                    metrics.merge (worker_metrics) # Stage spans and counters recorded by the worker
+                yield id, elapsed
+    
+    
+    def computes_phash (self, image):
+        """
+        Hashes a grayscale uint8 card image (as cropped by the segmenter, BGR images are converted). Returns its packed hash.
+        """
+        return self.computes_phashes ([image])[0]
+    
+    
+    def computes_phashes (self, images):
+        """
+        Hashes card images together. Returns their packed hashes, a (n, words) matrix.
+        """
+        with metrics.span ('hash'):
+            phashes = self.phasher.hash_batch (images)
+        metrics.count ('hash.images', len (images))
+        return phashes
         
         
     def compare_phash (self, phash):
-        if (self.verbose):
-            print ("\tComparing phashes...")
-            start_time = time.time ()
-        match = self.tree.get_nearest_neighbor (ReferenceImage ('', phash))
-        if (self.verbose):
-            exec_time = time.time () - start_time
-            print(f"\t\tDone in {round (exec_time, 5)} s")
-        return match[1].id
+        return self.compare_phashes (np.asarray (phash)[None])[0]
+    
+    
+    def compare_phashes (self, phashes):
+        """
+        Matches packed hashes together. Returns their ids (None for no match).
+        """
+        return [id for id, _, _ in self.match_phashes (phashes)]
+    
+    
+    def match_phashes (self, phashes):
+        """
+        Matches packed hashes together. Returns an (id, distance, margin to the second best) tuple for each, (None, None, None) for no match.
+        Margins may be overstated when the second best reference was not shortlisted (see 'PHashIndex.match_batch').
+        """
+        with metrics.span ('match'):
+            matches = self.index.match_batch (phashes, int (self.max_distance * self.index.hash_bits))
+        metrics.count ('match.rejected', sum (1 for id, _, _ in matches if id is None))
+        return matches
 
 
-    def build_tree (self):
-        ref_images = self.rw.get_references ()
-        ref_images_objects = []
+    def reload_index (self) -> bool:
+        """
+        Rebuilds the index if 'save' wrote new references since it was built. Returns whether it was rebuilt.
+        """
+        if (self.static_index):
+            return False
+        if (self.rw.get_references_mtime () == self.index_mtime):
+            return False
+        self.build_index ()
+        return True
+
+
+    def _read_image (self, image) -> np.ndarray:
+        """
+        Reads an image path or an encoded image (bytes), reduced for pre processing. Arrays are passed through.
+        """
+        if isinstance (image, str):
+            path = image
+            image = imread_reduced (path, PreProcessor.max_size)
+            if (image is None):
+                raise FileNotFoundError ("Unreadable image", path)
+        elif isinstance (image, (bytes, bytearray, memoryview)):
+            image = imdecode_reduced (bytes (image), PreProcessor.max_size)
+            if (image is None):
+                raise ValueError ("Undecodable image")
+        if (image is None):
+            raise ValueError ("No image")
+        return image
+
+
+    def build_index (self):
+        self.index_mtime = self.rw.get_references_mtime ()
         
-        # Converts json to ReferenceImages
-        if (self.verbose):
-            print ("\tConverting json to objects...")
-            start_time = time.time ()
-        for r in ref_images:
-            ref_images_objects.append (ReferenceImage (r['id'], imagehash.hex_to_hash(r['phash']).hash.flatten ()))
-        ref_images = ref_images_objects
-        if (self.verbose):
-            exec_time = time.time () - start_time
-            print(f"\t\tDone in {round (exec_time, 5)} s")
+        # Maps the precompiled index written by 'save'
+        self.index = self.rw.get_index ()
+        if (self.index is not None):
+            return
         
-        # Builds vp tree
-        if (self.verbose):
-            print ("\tBuilding vp tree...")
-            start_time = time.time ()
-        def hamming (a, b):
-            return np.count_nonzero(a.phash != b.phash)
-        self.tree = vptree.VPTree (ref_images, hamming)
+        # Falls back to decoding the json references
+        ref_images = self.rw.get_references ()
         if (self.verbose):
-            exec_time = time.time () - start_time
-            print(f"\t\tDone in {round (exec_time, 5)} s")
+            print ("\tBuilding index from json references...")
+        with metrics.span ('index.build'):
+            self.index = PHashIndex.from_references (ref_images)
@@ -0,0 +1,238 @@
+import os
+import json
+import stat
+import time
+import queue
+import socket
+import threading
+import traceback
+import socketserver
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from scanner import Scanner
+from metrics import metrics, PrometheusExporter
+
+
+class ScanServer:
+    """
+    Resident scanning service: keeps a scanner and its index warm, and serves scans over HTTP on a localhost port or a Unix socket.
+    Concurrent requests are queued, then scanned together in micro-batches by a single scanning thread (see 'Scanner.scan_many').
+    The index is rebuilt as soon as 'save' writes new references.
+
+    POST /scan      Body: an encoded image, or a json {'path': ...} or {'paths': [...]} object (paths are relative to the server).
+                    Returns {'id', 'time'}, with the 'path' for a path, or {'results': [...]} for several paths.
+                    'time' is the request latency in seconds, from its reception to its result.
+    GET  /status    Returns {'references', 'scanned', 'batches', 'reloads'}.
+    GET  /metrics   Returns the stage latencies and counters, in the Prometheus text format.
+    """
+    verbose : bool
+    scanner : Scanner
+
+    max_batch : int
+    """ Maximal number of images scanned together """
+    max_delay : float
+    """ Maximal time (s) a request waits for others to fill its batch """
+    reload_interval : float
+    """ Minimal time (s) between two checks of the references modification time """
+    exporter = None
+    """ Metrics exporter (see metrics.exporter_for), called as often as the references are checked, None for none """
+
+    scanned_count : int = 0
+    batch_count : int = 0
+    reload_count : int = 0
+
+    def __init__ (self, scanner:Scanner, max_batch:int=16, max_delay:float=0.002, reload_interval:float=1., exporter=None, verbose:bool=False):
+        self.scanner = scanner
+        self.max_batch = max (1, max_batch)
+        self.max_delay = max_delay
+        self.reload_interval = reload_interval
+        self.exporter = exporter
+        self.verbose = verbose
+        self._requests = queue.Queue ()
+        self._stopped = threading.Event ()
+
+
+    def run (self, port:int=8765, socket_path:str=None):
+        """
+        Serves requests until interrupted, on 127.0.0.1:port, or on a Unix socket if 'socket_path' is given.
+        """
+        if (socket_path is not None):
+            http_server = _UnixHTTPServer (socket_path, _ScanRequestHandler)
+            address = socket_path
+        else:
+            http_server = ThreadingHTTPServer (('127.0.0.1', port), _ScanRequestHandler)
+            address = f"http://127.0.0.1:{http_server.server_port}"
+        http_server.daemon_threads = True
+        http_server.scan_server = self
+        scan_thread = threading.Thread (target=self._scan_loop, name='scan', daemon=True)
+        scan_thread.start ()
+        print (f"Serving scans on {address}", flush=True)
+        try:
+            http_server.serve_forever ()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._stopped.set ()
+            http_server.server_close ()
+            scan_thread.join ()
+            self._export_metrics ()
+            if (socket_path is not None and os.path.exists (socket_path) and stat.S_ISSOCK (os.stat (socket_path).st_mode)):
+                os.remove (socket_path)
+
+
+    def submit (self, image) -> Future:
+        """
+        Queues an image, image path or encoded image. The future's result is its id (ids list in multi mode), None if it could not be scanned.
+        """
+        future = Future ()
+        self._requests.put ((image, future, time.perf_counter_ns ()))
+        return future
+
+
+    def status (self):
+        return {'references': len (self.scanner.index), 'scanned': self.scanned_count, 'batches': self.batch_count, 'reloads': self.reload_count}
+
+
+    def _next_batch (self):
+        """
+        Waits for a request, then for more requests until the batch is full or its delay has elapsed. Returns an empty batch
+        if no request came during 'reload_interval'.
+        """
+        try:
+            batch = [self._requests.get (timeout=self.reload_interval)]
+        except queue.Empty:
+            return []
+        deadline = time.perf_counter () + self.max_delay
+        while len (batch) < self.max_batch:
+            try:
+                batch.append (self._requests.get (timeout=max (0., deadline - time.perf_counter ())))
+            except queue.Empty:
+                break
+        return batch
+
+
+    def _scan_loop (self):
+        """
+        Scanning thread, the only one using the scanner.
+        """
+        last_check_time = time.perf_counter ()
+        while not self._stopped.is_set ():
+            batch = self._next_batch ()
+
+            # Hot reload: picks up the references written by 'save' between batches
+            if (time.perf_counter () - last_check_time >= self.reload_interval):
+                last_check_time = time.perf_counter ()
+                try:
+                    if (self.scanner.reload_index ()):
+                        self.reload_count += 1
+                        print (f"Reloaded {len (self.scanner.index)} references", flush=True)
+                except Exception:
+                    traceback.print_exc ()
+                self._export_metrics ()
+
+            if (len (batch) == 0):
+                continue
+            start_ns = time.perf_counter_ns ()
+            for _, _, submit_ns in batch:
+                metrics.observe ('server.wait', start_ns - submit_ns)
+            try:
+                with metrics.span ('server.batch'):
+                    results = self.scanner.scan_many ([image for image, _, _ in batch])
+            except Exception as exception:
+                traceback.print_exc ()
+                for _, future, _ in batch:
+                    future.set_exception (exception)
+                continue
+            for (_, future, _), result in zip (batch, results):
+                future.set_result (result)
+            self.scanned_count += len (batch)
+            self.batch_count += 1
+            if (self.verbose):
+                print (f"\tScanned a batch of {len (batch)} images", flush=True)
+
+
+    def _export_metrics (self):
+        if (self.exporter is None):
+            return
+        try:
+            self.exporter.export (metrics)
+        except OSError:
+            traceback.print_exc ()
+
+
+class _UnixHTTPServer (ThreadingHTTPServer):
+    address_family = socket.AF_UNIX
+
+    def server_bind (self):
+        if (os.path.exists (self.server_address) and stat.S_ISSOCK (os.stat (self.server_address).st_mode)):
+            os.remove (self.server_address) # Stale socket of a previous run
+        socketserver.TCPServer.server_bind (self)
+        self.server_name, self.server_port = 'localhost', 0
+
+
+class _ScanRequestHandler (BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # Keep-alive connections
+
+    def do_GET (self):
+        if (self.path == '/metrics'):
+            return self._reply_text (200, PrometheusExporter ().text (metrics), 'text/plain; version=0.0.4')
+        if (self.path != '/status'):
+            return self._reply (404, {'error': "Unknown path"})
+        self._reply (200, self.server.scan_server.status ())
+
+
+    def do_POST (self):
+        if (self.path != '/scan'):
+            return self._reply (404, {'error': "Unknown path"})
+        body = self.rfile.read (int (self.headers.get ('Content-Length', 0)))
+        start_time = time.perf_counter ()
+
+        # Encoded image or json paths
+        paths = None
+        if (body[:1] == b'{'):
+            try:
+                request = json.loads (body)
+                paths = request['paths'] if 'paths' in request else [request['path']]
+                if (not isinstance (paths, list)):
+                    raise ValueError ("Paths must be a list") # A string would be scanned character by character
+                if (not all (isinstance (path, str) for path in paths)):
+                    raise ValueError ("Paths must be strings")
+            except (ValueError, KeyError, TypeError) as exception:
+                return self._reply (400, {'error': f"Invalid request: {exception}"})
+        images = [body] if paths is None else paths
+
+        futures = [self.server.scan_server.submit (image) for image in images]
+        results = []
+        for i, future in enumerate (futures):
+            try:
+                id = future.result ()
+            except Exception:
+                id = None
+            result = {'id': id, 'time': round (time.perf_counter () - start_time, 5)}
+            if (paths is not None):
+                result = {'path': paths[i], **result}
+            results.append (result)
+        self._reply (200, {'results': results} if (paths is not None and 'paths' in request) else results[0])
+
+
+    def _reply (self, status:int, content):
+        self._reply_text (status, json.dumps (content), 'application/json')
+
+
+    def _reply_text (self, status:int, text:str, content_type:str):
+        body = text.encode ('utf-8')
+        self.send_response (status)
+        self.send_header ('Content-Type', content_type)
+        self.send_header ('Content-Length', str (len (body)))
+        self.end_headers ()
+        self.wfile.write (body)
+
+
+    def address_string (self):
+        return self.client_address[0] if isinstance (self.client_address, tuple) else 'unix'
+
+
+    def log_message (self, format, *args):
+        if (self.server.scan_server.verbose):
+            super ().log_message (format, *args)
@@ -1,12 +1,10 @@
-import time
-
 import numpy as np
-from shapely.affinity import scale
 import cv2 as cv
-import matplotlib.pyplot as plt
 
 from inputimage import InputImage
 from cardcandidate import CardCandidate
+from metrics import metrics
+from utils import characterize_card_contours, four_point_transform, _convex_intersection_area, _polygon_area, _scale_polygon
 
 class Thresholding:
     SIMPLE="simple"
@@ -18,28 +16,93 @@ class Segmenter:
     verbose : bool
     threshold : Thresholding
     
+    contour_mode : int = cv.RETR_CCOMP
+    """ Contour retrieval mode: a two level hierarchy (outer borders and their holes) is enough to find cards """
+    min_card_area : float = 0.02
+    """ Minimum area of a card contour, as a fraction of the image area """
+    max_card_aspect : float = 2.5
+    """ Maximum aspect ratio of a card contour bounding box """
+    card_aspect : float = 88 / 63
+    """ Card aspect ratio (long side / short side) """
+    
+    track_roi : bool
+    """ Whether to look for the card around its last position first (cards landing in the same place) """
+    roi_padding : float = 0.15
+    """ Padding around the last card bounding box, relative to its size """
+    roi : tuple = None
+    """ Bounding box (x, y, width, height) of the last card found by its geometry, None if lost """
+    roi_hits : int
+    """ Number of cards found in the region of interest """
+    roi_misses : int
+    """ Number of region of interest checks which failed, falling back on the full frame """
     
-    def __init__(self, threshold:Thresholding, verbose:bool=False):
+    
+    def __init__(self, threshold:Thresholding, verbose:bool=False, track_roi:bool=False):
         self.verbose = verbose
         self.threshold = threshold
+        self.track_roi = track_roi
+        self.roi_hits = 0
+        self.roi_misses = 0
 
 
-    def segment (self, test_image:InputImage) -> InputImage:
+    @metrics.timed ('segment')
+    def segment (self, test_image:InputImage, fallback:bool=True) -> InputImage:
+        """
+        Crops the card of the image. Without 'fallback', only a contour with the geometry of a card is accepted: raises ValueError
+        instead of falling back on the second largest contour.
+        """
         if (self.verbose):
             print("\tSegmenting...")
-            
-        start_time = time.time() # Performance stats
         
-        # Extracts contours from the preprocessed image
-        contours = self._contour_image (test_image)
-        contours = sorted (contours, key=cv.contourArea, reverse=True)
+        # Looks for the card around its last position first
+        card_contour = None
+        if (self.track_roi and self.roi is not None):
+            roi = self._padded_roi (self.roi, test_image.preprocessed_image.shape)
+            card_contour, _ = self._find_card_contour (test_image, roi)
+            if (card_contour is None):
+                self.roi_misses += 1
+                metrics.count ('segment.roi_misses')
+            else:
+                self.roi_hits += 1
+                metrics.count ('segment.roi_hits')
+        
+        # Looks for the card in the full frame
+        if (card_contour is None):
+            card_contour, contours = self._find_card_contour (test_image)
+            # Only a card found by its geometry is tracked
+            self.roi = cv.boundingRect (card_contour) if (self.track_roi and card_contour is not None) else None
+            if (card_contour is None):
+                # No card shaped contour, falls back on the second largest contour (the largest being usually the image border)
+                if (len (contours) == 0 or not fallback):
+                    raise ValueError ("No card contour found")
+                card_contour = contours[1] if len (contours) > 1 else contours[0]
+        else:
+            self.roi = cv.boundingRect (card_contour)
         
-        # Gets the card contours out of all contours
-        # TODO better contour selection
-        card_contour = contours[1]
+        with metrics.span ('segment.crop'):
+            card_image, card_rect = self._crop_card (test_image, card_contour)
         
+        # Modifies test image
+        test_image.card_image = card_image
+        test_image.card_rect = card_rect
+        
+        if (self.verbose and self.track_roi):
+            print(f"\t\tRegion of interest: {self.roi_hits} hits, {self.roi_misses} misses")
+        
+        return test_image
+
+
+    def _crop_card (self, test_image:InputImage, card_contour:np.ndarray) -> tuple[np.ndarray, tuple]:
+        """
+        Crops the grayscale image to the minimum area rectangle of a card contour, straightened.
+        Returns the card image and the rectangle.
+        """
         # Corrects rotation
         card_rect = cv.minAreaRect (card_contour) # ((center x, center y), (width, height), angle)
+        (center, (rect_width, rect_height), angle) = card_rect
+        if (rect_width > rect_height):
+            # Smallest rotation that stands the card upright (minAreaRect may describe it lying, rotated by about 90°)
+            card_rect = (center, (rect_height, rect_width), angle - 90 if angle > 0 else angle + 90)
         M = cv.getRotationMatrix2D (card_rect[0], card_rect[2], 1)
         card_vertices = np.int32 (np.round (cv.transform (np.array ([cv.boxPoints (card_rect)]), M)[0]))
 
@@ -50,74 +113,199 @@ class Segmenter:
         # plt.imshow (test_image.preprocessed_image)
         # plt.show(block=True)
         
-        card_image = cv.warpAffine (test_image.preprocessed_image, M, (test_image.preprocessed_image.shape[1], test_image.preprocessed_image.shape[0]))
+        # Crops the grayscale image: only the card window (clipped to the image) of the rotated image is computed
+        height, width = test_image.gray_image.shape[0], test_image.gray_image.shape[1]
+        x0, y0 = np.clip (card_vertices[1], 0, (width, height))
+        x1, y1 = np.clip ((card_vertices[2][0], card_vertices[0][1]), (x0, y0), (width, height))
+        M[:, 2] -= (x0, y0)
+        if (x1 > x0 and y1 > y0):
+            card_image = cv.warpAffine (test_image.gray_image, M, (int (x1 - x0), int (y1 - y0)))
+        else:
+            card_image = test_image.gray_image[y0:y1, x0:x1] # Empty
+        return card_image, card_rect
+
+
+    @metrics.timed ('segment_all')
+    def segment_all (self, test_image:InputImage) -> list[CardCandidate]:
+        """
+        Finds every card in the image, as perspective corrected card candidates
+        """
+        if (self.verbose):
+            print("\tSegmenting all cards...")
+        
+        # Extracts contours from the preprocessed image, largest first (areas computed once)
+        with metrics.span ('segment.contours'):
+            contours = self._contour_image (test_image)
+        areas = np.array ([cv.contourArea (contour) for contour in contours])
+        contours = [contours[i] for i in np.argsort (-areas, kind='stable')]
+        
+        image = test_image.gray_image
+        image_area = image.shape[0] * image.shape[1]
         
-        # Crops image
-        card_image = card_image[card_vertices[1][1]:card_vertices[0][1], card_vertices[1][0]:card_vertices[2][0]]
+        # A card touching the image border is not entirely visible (and the image border itself is not a card)
+        rects = np.array ([cv.boundingRect (contour) for contour in contours]).reshape (-1, 4)
+        inside = ((rects[:, 0] > 1) & (rects[:, 1] > 1) &
+                  (rects[:, 0] + rects[:, 2] < image.shape[1] - 1) & (rects[:, 1] + rects[:, 3] < image.shape[0] - 1))
+        contours = [contour for contour, keep in zip (contours, inside) if keep]
+        
+        # Scores contours until the card size range has been explored
+        candidates = []
+        for (is_card_candidate, bounding_poly, crop_factor) in characterize_card_contours (contours, 0., image_area):
+            if (not is_card_candidate):
+                continue
+            # Discards candidates overlapping an already found card (such as its art box)
+            area = _polygon_area (bounding_poly)
+            if any (_convex_intersection_area (bounding_poly, c.bounding_poly) > 0.5 * min (area, _polygon_area (c.bounding_poly)) for c in candidates):
+                continue
+            
+            # Corrects perspective, cards are upright or sideways: puts them upright
+            card_image = four_point_transform (image, _scale_polygon (bounding_poly, crop_factor))
+            if (card_image.shape[1] > card_image.shape[0]):
+                card_image = cv.rotate (card_image, cv.ROTATE_90_CLOCKWISE)
+            candidates.append (CardCandidate (card_image, bounding_poly))
         
         # Modifies test image
-        test_image.card_image = card_image
+        test_image.candidates = candidates
         
+        metrics.count ('segment_all.cards', len (candidates))
         if (self.verbose):
-            exec_time = time.time() - start_time
-            print(f"\t\tDone in {round (exec_time, 5)} s")
+            print(f"\t\tFound {len (candidates)} cards")
         
-        return test_image
+        return candidates
 
 
-    def _contour_image (self, test_image:InputImage) -> tuple[np.ndarray]:
+    def _find_card_contour (self, test_image:InputImage, roi:tuple=None) -> tuple[np.ndarray, list]:
+        """
+        Finds a card shaped contour in the whole preprocessed image, or only in a region of interest (x, y, width, height).
+        A card found in a region of interest must not touch its border (it could be cut).
+        Returns the card contour (None if no card is found) and the filtered contours.
+        """
+        if (roi is not None and (roi[2] == 0 or roi[3] == 0)):
+            return None, [] # Region out of the image
+        with metrics.span ('segment.contours'):
+            contours = self._contour_image (test_image, roi)
+        with metrics.span ('segment.filter'):
+            contours, areas = self._filter_contours (contours, test_image.preprocessed_image.shape)
+        with metrics.span ('segment.selection'):
+            bounds = roi if roi is not None else (0, 0, test_image.preprocessed_image.shape[1], test_image.preprocessed_image.shape[0])
+            card_contour = self._select_card_contour (contours, areas, bounds, roi is not None)
+        return card_contour, contours
+    
+    
+    def _padded_roi (self, box:tuple, image_shape) -> tuple:
+        """
+        Pads a bounding box (x, y, width, height), clipped to the image.
+        """
+        x, y, w, h = box
+        pad_x, pad_y = int (np.ceil (self.roi_padding * w)), int (np.ceil (self.roi_padding * h))
+        x0, y0 = max (0, x - pad_x), max (0, y - pad_y)
+        x1, y1 = min (image_shape[1], x + w + pad_x), min (image_shape[0], y + h + pad_y)
+        return (x0, y0, max (0, x1 - x0), max (0, y1 - y0))
+    
+    
+    def _filter_contours (self, contours, image_shape) -> tuple[list, np.ndarray]:
+        """
+        Discards contours too small or too elongated to be a card, with vectorized checks on their areas
+        (computed once) then on the bounding boxes of the remaining ones. Returns these contours, largest first, and their areas.
+        """
+        image_area = image_shape[0] * image_shape[1]
+        areas = np.array ([cv.contourArea (contour) for contour in contours]).reshape (-1)
+        keep = np.flatnonzero (areas >= self.min_card_area * image_area)
+        
+        rects = np.array ([cv.boundingRect (contours[i]) for i in keep]).reshape (-1, 4)
+        sides = np.sort (rects[:, 2:], axis=1)
+        keep = keep[sides[:, 1] <= self.max_card_aspect * sides[:, 0]]
+        
+        order = keep[np.argsort (-areas[keep], kind='stable')]
+        return [contours[i] for i in order], areas[order]
+    
+    
+    def _select_card_contour (self, contours, areas:np.ndarray, bounds:tuple, inside:bool=False) -> np.ndarray:
+        """
+        Picks the contour which looks the most like a card: the largest one which is not the border of the searched
+        region (x, y, width, height), or does not touch it if 'inside', whose minimum area rectangle has a card
+        aspect ratio and is filled by its convex hull, and which is solid (not a card merged with background blobs).
+        Returns None if no contour looks like a card.
+        """
+        bx0, by0, bx1, by1 = bounds[0], bounds[1], bounds[0] + bounds[2], bounds[1] + bounds[3]
+        for contour, area in zip (contours, areas):
+            x, y, w, h = cv.boundingRect (contour)
+            on_border = (x <= bx0 + 1, y <= by0 + 1, x + w >= bx1 - 1, y + h >= by1 - 1)
+            if (any (on_border) if inside else all (on_border)):
+                continue # Region border, or card going out of the region
+            (_, (rect_w, rect_h), _) = cv.minAreaRect (contour)
+            if (min (rect_w, rect_h) == 0):
+                continue
+            aspect = max (rect_w, rect_h) / min (rect_w, rect_h)
+            hull_area = cv.contourArea (cv.convexHull (contour))
+            if (abs (aspect - self.card_aspect) < 0.25 * self.card_aspect and
+                hull_area > 0.85 * rect_w * rect_h and area > 0.8 * hull_area):
+                return contour
+        return None
+    
+    
+    def _contour_image (self, test_image:InputImage, roi:tuple=None) -> tuple[np.ndarray]:
         """ 
-        Wrapper for contouring methods
+        Wrapper for contouring methods, on the whole image or on a region of interest (x, y, width, height).
+        Contours are always in whole image coordinates, the thresholded image only covers the contoured region.
         """
         match (self.threshold):
             case Thresholding.SIMPLE:
-                return self._contour_image_simple (test_image)
+                return self._contour_image_simple (test_image, roi)
             case Thresholding.ADAPTATIVE:
-                return self._contour_image_adaptative (test_image)
+                return self._contour_image_adaptative (test_image, roi)
             case Thresholding.RGB:
-                return self._contour_image_rgb (test_image)
+                return self._contour_image_rgb (test_image, roi)
             case _:
                 raise ValueError ("Unknown threshold method", self.threshold)
+    
+    
+    def _region (self, image:np.ndarray, roi:tuple) -> tuple[np.ndarray, tuple]:
+        """
+        Returns the part of a (preprocessed or gray) image to contour, and its offset in the whole image.
+        """
+        if (roi is None):
+            return image, (0, 0)
+        x, y, w, h = roi
+        return image[y:y + h, x:x + w], (x, y)
                 
 
-    def _contour_image_simple(self, test_image:InputImage) -> tuple[np.ndarray]:
+    def _contour_image_simple(self, test_image:InputImage, roi:tuple=None) -> tuple[np.ndarray]:
         """
         Contours given image with simple thresholding
         """
-        pp_image = test_image.preprocessed_image
-        
-        grayed = cv.cvtColor(pp_image, cv.COLOR_BGR2GRAY)
+        grayed, offset = self._region (test_image.gray_image, roi)
 
         _, thresholded = cv.threshold(grayed, 70, 255, cv.THRESH_BINARY)
         test_image.thresholded_image = thresholded
 
-        contours, _ = cv.findContours(np.uint8(thresholded), cv.RETR_TREE, cv.CHAIN_APPROX_SIMPLE)
+        contours, _ = cv.findContours(thresholded, self.contour_mode, cv.CHAIN_APPROX_SIMPLE, offset=offset)
 
         return contours
 
 
-    def _contour_image_adaptative(self, test_image:InputImage) -> tuple[np.ndarray]:
+    def _contour_image_adaptative(self, test_image:InputImage, roi:tuple=None) -> tuple[np.ndarray]:
         """
         Contours given image with adaptative thresholding
         """
-        pp_image = test_image.preprocessed_image
-
-        grayed = cv.cvtColor(pp_image, cv.COLOR_BGR2GRAY)
+        grayed, offset = self._region (test_image.gray_image, roi)
 
-        block_size = 1 + 2 * (min(pp_image.shape[0], pp_image.shape[1] // 20))
+        # Same block size for a region of interest as for the whole image
+        image_shape = test_image.preprocessed_image.shape
+        block_size = 1 + 2 * (min(image_shape[0], image_shape[1] // 20))
         thresholded = cv.adaptiveThreshold(grayed, 255, cv.ADAPTIVE_THRESH_GAUSSIAN_C, cv.THRESH_BINARY, block_size, 10)
         test_image.thresholded_image = thresholded
 
-        contours, _ = cv.findContours(np.uint8(thresholded), cv.RETR_TREE, cv.CHAIN_APPROX_SIMPLE)
+        contours, _ = cv.findContours(thresholded, self.contour_mode, cv.CHAIN_APPROX_SIMPLE, offset=offset)
 
         return contours
 
 
-    def _contour_image_rgb(self, test_image:InputImage) -> tuple[np.ndarray]:
+    def _contour_image_rgb(self, test_image:InputImage, roi:tuple=None) -> tuple[np.ndarray]:
         """
         Contours given image with simple RGB thresholding
         """
-        pp_image = test_image.preprocessed_image
+        pp_image, offset = self._region (test_image.preprocessed_image, roi)
 
         blue = pp_image[..., 0]
         green = pp_image[..., 1]
@@ -130,9 +318,9 @@ class Segmenter:
         thresholded = cv.merge((threshold_blue, threshold_green, threshold_red))
         test_image.thresholded_image = thresholded
 
-        contours_blue, _ = cv.findContours(np.uint8(threshold_blue), cv.RETR_TREE, cv.CHAIN_APPROX_SIMPLE)
-        contours_green, _ = cv.findContours(np.uint8(threshold_green), cv.RETR_TREE, cv.CHAIN_APPROX_SIMPLE)
-        contours_red, _ = cv.findContours(np.uint8(threshold_red), cv.RETR_TREE, cv.CHAIN_APPROX_SIMPLE)
+        contours_blue, _ = cv.findContours(threshold_blue, self.contour_mode, cv.CHAIN_APPROX_SIMPLE, offset=offset)
+        contours_green, _ = cv.findContours(threshold_green, self.contour_mode, cv.CHAIN_APPROX_SIMPLE, offset=offset)
+        contours_red, _ = cv.findContours(threshold_red, self.contour_mode, cv.CHAIN_APPROX_SIMPLE, offset=offset)
         contours = contours_blue + contours_green + contours_red
 
         return contours
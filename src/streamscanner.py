@@ -0,0 +1,147 @@
+import time
+
+import numpy as np
+import cv2 as cv
+
+from inputimage import InputImage
+from scanner import Scanner
+from metrics import metrics
+
+class StreamScanner:
+    """
+    Identifies cards from a continuous video stream (camera or video file).
+    Sampled frames are pre processed and segmented to follow the card in front of the camera; a card is hashed and
+    matched only once, when it has settled. A new identification needs the card to leave, or to be replaced.
+    """
+    verbose : bool
+    scanner : Scanner
+    
+    frame_skip : int
+    """ Only 1 frame out of 'frame_skip' is analyzed """
+    settle_frames : int
+    """ Number of consecutive analyzed frames on which the card must be still before being identified """
+    min_card_area : float
+    """ Minimal area of a card, relative to the frame area """
+    max_motion : float
+    """ Maximal move of the card between two analyzed frames, relative to the frame size """
+    max_content_diff : float
+    """ Maximal mean difference (0-255) between two thumbnails of the same card """
+    thumbnail_size : int = 32
+    
+    def __init__ (self, scanner:Scanner, frame_skip:int=3, settle_frames:int=3, min_card_area:float=0.05,
+                  max_motion:float=0.02, max_content_diff:float=20., verbose:bool=False):
+        self.scanner = scanner
+        self.frame_skip = max (1, frame_skip)
+        self.settle_frames = settle_frames
+        self.min_card_area = min_card_area
+        self.max_motion = max_motion
+        self.max_content_diff = max_content_diff
+        self.verbose = verbose
+    
+    
+    def run (self, source):
+        """
+        Reads frames from a cv.VideoCapture source (camera index, file path or url) until it ends.
+        Yields a {'frame', 'id', 'distance', 'margin', 'time'} record each time a new card has settled, 'time' being its identification time
+        (see 'Scanner.match_phashes', 'id' is None if the card matches no reference).
+        """
+        capture = cv.VideoCapture (source)
+        if not capture.isOpened ():
+            raise ValueError ("Unable to open video source", source)
+        start_time = time.perf_counter ()
+        frame_count, analyzed_count, identified_count = 0, 0, 0
+        
+        last_card = None        # (rect, thumbnail) of the card on the last analyzed frame
+        identified_card = None  # (rect, thumbnail) of the last identified card, while it stays in front of the camera
+        still_count = 0
+        try:
+            while True:
+                # Skipped frames are grabbed but not decoded
+                if frame_count % self.frame_skip != 0:
+                    if not capture.grab ():
+                        break
+                    frame_count += 1
+                    continue
+                ok, frame = capture.read ()
+                if not ok:
+                    break
+                frame_count += 1
+                analyzed_count += 1
+                
+                input_img_obj = self._detect_card (frame)
+                if (input_img_obj is None):
+                    # No card: the next card will be a new one
+                    last_card, identified_card, still_count = None, None, 0
+                    continue
+                card = (self._position (input_img_obj), self._thumbnail (input_img_obj.card_image))
+                
+                still_count = still_count + 1 if (last_card is not None and self._same_card (card, last_card)) else 0
+                last_card = card
+                if (identified_card is not None and not self._same_card (card, identified_card, still=False)):
+                    identified_card = None # Card replaced
+                
+                # Identifies a settled card, once
+                if (still_count >= self.settle_frames - 1 and identified_card is None):
+                    identify_start_time = time.perf_counter ()
+                    phashes = self.scanner.computes_phashes ([input_img_obj.card_image])
+                    id, distance, margin = self.scanner.match_phashes (phashes)[0]
+                    identified_card = card
+                    identified_count += 1
+                    yield {'frame': frame_count - 1, 'id': id, 'distance': distance, 'margin': margin,
+                           'time': round (time.perf_counter () - identify_start_time, 5)}
+        finally:
+            capture.release ()
+            metrics.count ('stream.frames', frame_count)
+            metrics.count ('stream.analyzed', analyzed_count)
+            metrics.count ('stream.identified', identified_count)
+            if (self.verbose):
+                exec_time = time.perf_counter () - start_time
+                print (f"\tRead {frame_count} frames ({round (frame_count / max (exec_time, 1e-9), 1)} fps), analyzed {analyzed_count}, identified {identified_count} cards in {round (exec_time, 5)} s")
+                if (self.scanner.seg.track_roi):
+                    print (f"\tRegion of interest: {self.scanner.seg.roi_hits} hits, {self.scanner.seg.roi_misses} misses")
+    
+    
+    def _detect_card (self, frame:np.ndarray):
+        """
+        Pre processes and segments a frame. Returns the image object, or None if no card is in the frame.
+        Only a contour with the geometry of a card counts (the segmenter fallback, often the frame border, would make empty frames settle).
+        """
+        input_img_obj = InputImage (frame)
+        try:
+            self.scanner.pp.pre_process_image (input_img_obj, self.scanner.clahe)
+            self.scanner.seg.segment (input_img_obj, fallback=False)
+        except (IndexError, ValueError, cv.error):
+            return None
+        (_, (width, height), _) = input_img_obj.card_rect
+        frame_area = input_img_obj.preprocessed_image.shape[0] * input_img_obj.preprocessed_image.shape[1]
+        if (width * height < self.min_card_area * frame_area or input_img_obj.card_image.size == 0):
+            return None
+        return input_img_obj
+    
+    
+    def _position (self, input_img_obj:InputImage) -> np.ndarray:
+        """
+        Card center and area, relative to the frame size.
+        """
+        ((x, y), (width, height), _) = input_img_obj.card_rect
+        (frame_height, frame_width) = input_img_obj.preprocessed_image.shape[:2]
+        return np.array ([x / frame_width, y / frame_height, width * height / (frame_width * frame_height)])
+    
+    
+    def _thumbnail (self, card_image:np.ndarray) -> np.ndarray:
+        return cv.resize (card_image, (self.thumbnail_size, self.thumbnail_size), interpolation=cv.INTER_AREA).astype (np.float32)
+    
+    
+    def _same_card (self, card, other_card, still:bool=True) -> bool:
+        """
+        Whether two detections show the same card: same content and, if 'still', same position.
+        """
+        position, thumbnail = card
+        other_position, other_thumbnail = other_card
+        if (np.mean (np.abs (thumbnail - other_thumbnail)) > self.max_content_diff):
+            return False
+        if (still):
+            if (np.hypot (*(position[:2] - other_position[:2])) > self.max_motion or
+                    abs (position[2] - other_position[2]) > self.max_motion * 5 * position[2]):
+                return False
+        return True
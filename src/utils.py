@@ -1,16 +1,60 @@
-from itertools import product
+from collections import deque
+import io
+import math
+from itertools import combinations
 import numpy as np
-from shapely.geometry import LineString
 from shapely.geometry.polygon import Polygon
 import cv2
+from PIL import Image as PILImage
+
+def pack_bits(bits, batch=False, dtype=np.uint64):
+    """
+    Packs boolean hashes, most significant bit first, into fixed-width rows of uint64 words or of bytes (dtype=np.uint8),
+    zero-padded to a whole number of them. 'bits' is one hash of any shape, or a batch of hashes along its first axis.
+    """
+    bits = np.asarray(bits, dtype=bool)
+    count = bits.shape[0] if batch else 1
+    bits = bits.reshape(count, int(np.prod(bits.shape[1:])) if batch else bits.size)
+    width = np.dtype(dtype).itemsize * 8
+    padding = -bits.shape[1] % width
+    if padding:
+        bits = np.concatenate((bits, np.zeros((count, padding), dtype=bool)), axis=1)
+    packed = np.packbits(bits, axis=1).view(dtype)
+    return packed if batch else packed[0]
+
+def _reduced_flag(header, max_size):
+    """
+    Returns the imread flag of the smallest JPEG decoding scale (1/8, 1/4, 1/2 or full) whose longest side still
+    covers max_size, from the image header (a path or a file object). Returns None if the image cannot be read.
+    """
+    try:
+        with PILImage.open(header) as image:  # only parses the header
+            longest_side = max(image.size)
+    except (OSError, ValueError):
+        return None
+    for factor, flag in ((8, cv2.IMREAD_REDUCED_COLOR_8),
+                         (4, cv2.IMREAD_REDUCED_COLOR_4),
+                         (2, cv2.IMREAD_REDUCED_COLOR_2)):
+        if longest_side // factor >= max_size:
+            return flag
+    return cv2.IMREAD_COLOR
+
+def imread_reduced(path, max_size):
+    """
+    Reads an image at the smallest JPEG decoding scale (1/8, 1/4, 1/2 or full)
+    whose longest side still covers max_size, skipping the full size decode.
+    Returns None if the image cannot be read.
+    """
+    flag = _reduced_flag(path, max_size)
+    return None if flag is None else cv2.imread(path, flag)
+
+def imdecode_reduced(content, max_size):
+    """
+    Same as imread_reduced, for an encoded image in memory (bytes).
+    """
+    flag = _reduced_flag(io.BytesIO(content), max_size)
+    return None if flag is None else cv2.imdecode(np.frombuffer(content, dtype=np.uint8), flag)
 
-def binary_array_to_dec (bin_array):
-    string = ''
-    for byte in bin_array:
-        for bit in byte:
-            string += str (int (bit))
-    dec = int (string, 2)
-    return dec
 
 def _order_polygon_points(x, y):
     """
@@ -24,13 +68,11 @@ def _order_polygon_points(x, y):
 
 def four_point_transform(image, poly):
     """
-    A perspective transform for a quadrilateral polygon.
+    A perspective transform for a quadrilateral polygon ((4, 2) array).
     Slightly modified version of the same function from
     https://github.com/EdjeElectronics/OpenCV-Playing-Card-Detector
     """
-    pts = np.zeros((4, 2))
-    pts[:, 0] = np.asarray(poly.exterior.coords)[:-1, 0]
-    pts[:, 1] = np.asarray(poly.exterior.coords)[:-1, 1]
+    pts = np.asarray(poly, dtype=float)
     # obtain a consistent order of the points and unpack them
     # individually
     rect = np.zeros((4, 2))
@@ -116,37 +158,45 @@ def _simplify_polygon(in_poly,
     rounded polygons (quadrilaterals) with more sharp-cornered ones.
     """
 
-    x_in = np.asarray(in_poly.exterior.coords)[:-1, 0]
-    y_in = np.asarray(in_poly.exterior.coords)[:-1, 1]
+    # Plain lists: the polygons are small and shrink at each iteration,
+    # only the lengths of the two segments around the new point change
+    x_in = [float(x) for x in in_poly[:, 0]]
+    y_in = [float(y) for y in in_poly[:, 1]]
     len_poly = len(x_in)
+
+    def length(i):
+        j = (i + 1) % len_poly
+        return math.sqrt((x_in[j] - x_in[i]) ** 2. + (y_in[j] - y_in[i]) ** 2.)
+
+    d_in = [length(i) for i in range(len_poly)]
     niter = 0
     if segment_to_remove is not None:
         maxiter = 1
     while len_poly > 4:
-        d_in = np.sqrt(np.ediff1d(x_in, to_end=x_in[0] - x_in[-1]) ** 2. +
-                       np.ediff1d(y_in, to_end=y_in[0] - y_in[-1]) ** 2.)
-        d_tot = np.sum(d_in)
+        d_tot = math.fsum(d_in)
         if segment_to_remove is not None:
             k = segment_to_remove
         else:
-            k = np.argmin(d_in)
+            k = min(range(len_poly), key=d_in.__getitem__)
         if d_in[k] < length_cutoff * d_tot:
             ind = _generate_point_indices(k - 1, k + 1, len_poly)
-            (xis, yis) = _line_intersection(x_in[ind], y_in[ind])
+            (xis, yis) = _line_intersection([x_in[i] for i in ind],
+                                            [y_in[i] for i in ind])
             x_in[k] = xis
             y_in[k] = yis
-            x_in = np.delete(x_in, (k + 1) % len_poly)
-            y_in = np.delete(y_in, (k + 1) % len_poly)
+            removed = (k + 1) % len_poly
+            del x_in[removed], y_in[removed], d_in[removed]
             len_poly = len(x_in)
+            k = k if removed > k else k - 1
+            d_in[k - 1] = length(k - 1)
+            d_in[k] = length(k)
             niter += 1
             if (maxiter is not None) and (niter >= maxiter):
                 break
         else:
             break
 
-    out_poly = Polygon([[ix, iy] for (ix, iy) in zip(x_in, y_in)])
-
-    return out_poly
+    return np.column_stack((x_in, y_in))
 
 
 def _generate_point_indices(index_1, index_2, max_len):
@@ -161,93 +211,237 @@ def _generate_point_indices(index_1, index_2, max_len):
                      (index_2 + 1) % max_len])
 
 
-def _generate_quad_corners(indices, x, y):
-    """
-    Returns the four intersection points from the
-    segments defined by the x coordinates (x),
-    y coordinates (y), and the indices.
-    """
-    (i, j, k, l) = indices
-
-    def gpi(index_1, index_2):
-        return _generate_point_indices(index_1, index_2, len(x))
-
-    xis = np.empty(4)
-    yis = np.empty(4)
-    xis.fill(np.nan)
-    yis.fill(np.nan)
-
-    if j <= i or k <= j or l <= k:
-        pass
-    else:
-        (xis[0], yis[0]) = _line_intersection(x[gpi(i, j)],
-                                             y[gpi(i, j)])
-        (xis[1], yis[1]) = _line_intersection(x[gpi(j, k)],
-                                             y[gpi(j, k)])
-        (xis[2], yis[2]) = _line_intersection(x[gpi(k, l)],
-                                             y[gpi(k, l)])
-        (xis[3], yis[3]) = _line_intersection(x[gpi(l, i)],
-                                             y[gpi(l, i)])
-
-    return (xis, yis)
-
-
 def _generate_quad_candidates(in_poly):
     """
-    Generates a list of bounding quadrilaterals for a polygon,
+    Generates the bounding quadrilaterals ((n, 4, 2) array) of a polygon,
     using all possible combinations of four intersection points
     derived from four extended polygon segments.
-    The number of combinations increases rapidly with the order
-    of the polygon, so simplification should be applied first to
-    remove very short segments from the polygon.
+    Every combination is evaluated at once with numpy: corners are
+    batched line intersections, and containment is tested with edge
+    cross products (shapely is only used for non-convex quads).
     """
     # make sure that the points are ordered
-    (x_s, y_s) = _order_polygon_points(
-        np.asarray(in_poly.exterior.coords)[:-1, 0],
-        np.asarray(in_poly.exterior.coords)[:-1, 1])
+    (x_s, y_s) = _order_polygon_points(in_poly[:, 0], in_poly[:, 1])
     x_s_ave = np.average(x_s)
     y_s_ave = np.average(y_s)
     x_shrunk = x_s_ave + 0.9999 * (x_s - x_s_ave)
     y_shrunk = y_s_ave + 0.9999 * (y_s - y_s_ave)
-    shrunk_poly = Polygon([[x, y] for (x, y) in
-                           zip(x_shrunk, y_shrunk)])
-    quads = []
     len_poly = len(x_s)
-
-    for indices in product(range(len_poly), repeat=4):
-        (xis, yis) = _generate_quad_corners(indices, x_s, y_s)
-        if (np.sum(np.isnan(xis)) + np.sum(np.isnan(yis))) > 0:
-            # no intersection point for some of the lines
-            pass
-        else:
-            (xis, yis) = _order_polygon_points(xis, yis)
-            enclose = True
-            quad = Polygon([(xis[0], yis[0]),
-                            (xis[1], yis[1]),
-                            (xis[2], yis[2]),
-                            (xis[3], yis[3])])
-            if not quad.contains(shrunk_poly):
-                enclose = False
-            if enclose:
-                quads.append(quad)
-    return quads
+    if len_poly < 4:
+        return np.zeros((0, 4, 2))
+
+    # Segments i < j < k < l, only those yield four intersection points
+    indices = np.array(list(combinations(range(len_poly), 4)))
+    (xis, yis) = _segment_intersections(
+        indices, np.roll(indices, -1, axis=1), x_s, y_s)
+    valid = ~(np.isnan(xis).any(axis=1) | np.isnan(yis).any(axis=1))
+    (xis, yis) = (xis[valid], yis[valid])
+    if len(xis) == 0:
+        return np.zeros((0, 4, 2))
+
+    # Orders the corners of each quad
+    angle = np.arctan2(yis - np.average(yis, axis=1)[:, None],
+                       xis - np.average(xis, axis=1)[:, None])
+    ind = np.argsort(angle, axis=1)
+    xis = np.take_along_axis(xis, ind, axis=1)
+    yis = np.take_along_axis(yis, ind, axis=1)
+
+    # Edge vectors, orientation and convexity of each quad
+    ex = np.roll(xis, -1, axis=1) - xis
+    ey = np.roll(yis, -1, axis=1) - yis
+    turns = ex * np.roll(ey, -1, axis=1) - ey * np.roll(ex, -1, axis=1)
+    orientation = np.sign(np.sum(xis * np.roll(yis, -1, axis=1) -
+                                 np.roll(xis, -1, axis=1) * yis, axis=1))
+    convex = np.all(turns * orientation[:, None] >= 0, axis=1) & \
+        (orientation != 0)
+
+    # A convex quad contains the shrunk polygon iff every polygon point is
+    # on the inner side of (or on) its four edges
+    sides = ex[:, :, None] * (y_shrunk[None, None, :] - yis[:, :, None]) - \
+        ey[:, :, None] * (x_shrunk[None, None, :] - xis[:, :, None])
+    enclose = np.all(sides * orientation[:, None, None] >= 0, axis=(1, 2))
+
+    # Non-convex quads (rare) are checked with shapely
+    for iquad in np.flatnonzero(~convex):
+        shrunk_poly = Polygon([[x, y] for (x, y) in zip(x_shrunk, y_shrunk)])
+        quad = Polygon(list(zip(xis[iquad], yis[iquad])))
+        enclose[iquad] = quad.contains(shrunk_poly)
+
+    return np.stack((xis[enclose], yis[enclose]), axis=2)
+
+
+def _segment_intersections(index_1, index_2, x, y):
+    """
+    Vectorized _line_intersection of the polygon segments starting at
+    index_1 and index_2 (arrays of the same shape). Parallel segments
+    give (nan, nan).
+    """
+    len_poly = len(x)
+    (x0, y0) = (x[index_1 % len_poly], y[index_1 % len_poly])
+    (x1, y1) = (x[(index_1 + 1) % len_poly], y[(index_1 + 1) % len_poly])
+    (x2, y2) = (x[index_2 % len_poly], y[index_2 % len_poly])
+    (x3, y3) = (x[(index_2 + 1) % len_poly], y[(index_2 + 1) % len_poly])
+    slope_0 = (x0 - x1) * (y2 - y3)
+    slope_2 = (y0 - y1) * (x2 - x3)
+    denom = slope_0 - slope_2
+    parallel = slope_0 == slope_2
+    denom = np.where(parallel, 1., denom)
+    xy_01 = x0 * y1 - y0 * x1
+    xy_23 = x2 * y3 - y2 * x3
+    xis = np.where(parallel, np.nan,
+                   (xy_01 * (x2 - x3) - (x0 - x1) * xy_23) / denom)
+    yis = np.where(parallel, np.nan,
+                   (xy_01 * (y2 - y3) - (y0 - y1) * xy_23) / denom)
+    return (xis, yis)
 
 
 def _get_bounding_quad(hull_poly):
     """
-    Returns the minimum area quadrilateral that contains (bounds)
-    the convex hull (openCV format) given as input.
+    Returns the minimum area quadrilateral ((4, 2) array) that contains
+    (bounds) the convex hull ((n, 2) array) given as input.
     """
     simple_poly = _simplify_polygon(hull_poly)
     bounding_quads = _generate_quad_candidates(simple_poly)
-    bquad_areas = np.zeros(len(bounding_quads))
-    for iquad, bquad in enumerate(bounding_quads):
-        bquad_areas[iquad] = bquad.area
+    bquad_areas = _polygon_area(bounding_quads)
     min_area_quad = bounding_quads[np.argmin(bquad_areas)]
 
     return min_area_quad
 
 
+def _signed_polygon_area(poly):
+    """
+    Shoelace formula on the last two axes of a (..., n, 2) array of
+    polygons. Positive for counterclockwise polygons (y axis up).
+    """
+    x = poly[..., 0]
+    y = poly[..., 1]
+    return 0.5 * (np.sum(x[..., :-1] * y[..., 1:] - x[..., 1:] * y[..., :-1],
+                         axis=-1) + x[..., -1] * y[..., 0] - x[..., 0] * y[..., -1])
+
+
+def _polygon_area(poly):
+    """
+    Area of one polygon ((n, 2) array) or of a stack of polygons.
+    """
+    return np.abs(_signed_polygon_area(np.asarray(poly, dtype=float)))
+
+
+def _next_points(points):
+    """
+    The points following each point of a closed polygon (or ring of values).
+    """
+    return np.concatenate((points[1:], points[:1]))
+
+
+def _polygon_centroid(poly):
+    """
+    Area centroid of a polygon ((n, 2) array).
+    """
+    (x, y) = (poly[:, 0], poly[:, 1])
+    (x_next, y_next) = (_next_points(x), _next_points(y))
+    cross = x * y_next - x_next * y
+    area = 0.5 * np.sum(cross)
+    if area == 0:
+        return np.average(poly, axis=0)
+    cx = np.sum((x + x_next) * cross) / (6. * area)
+    cy = np.sum((y + y_next) * cross) / (6. * area)
+    return np.array([cx, cy])
+
+
+def _scale_polygon(poly, factor):
+    """
+    Scales a polygon ((n, 2) array) around its centroid.
+    """
+    centroid = _polygon_centroid(poly)
+    return centroid + factor * (poly - centroid)
+
+
+def _clip_polygon(poly, clip_poly, orientation=None):
+    """
+    Intersection of a polygon with a convex polygon (both (n, 2) arrays),
+    with the Sutherland-Hodgman algorithm, each clipping edge being
+    applied to every polygon point at once.
+    """
+    if orientation is None:
+        orientation = np.sign(_signed_polygon_area(clip_poly))
+    edges = (_next_points(clip_poly) - clip_poly) * orientation
+    for (a, edge) in zip(clip_poly.tolist(), edges.tolist()):
+        if len(poly) == 0:
+            break
+        side = (edge[0] * (poly[:, 1] - a[1]) -
+                edge[1] * (poly[:, 0] - a[0]))
+        next_side = _next_points(side)
+        inside = side >= 0
+        crossing = inside != (next_side >= 0)
+        t = np.divide(side, side - next_side,
+                      out=np.zeros_like(side), where=crossing)
+        # Each kept point is followed by the edge intersection, if any
+        points = np.empty((2 * len(poly), 2))
+        points[0::2] = poly
+        points[1::2] = poly + (_next_points(poly) - poly) * t[:, None]
+        keep = np.empty(2 * len(poly), dtype=bool)
+        keep[0::2] = inside
+        keep[1::2] = crossing
+        poly = points[keep]
+    return poly
+
+
+def _convex_intersection_area(poly_1, poly_2):
+    """
+    Area of the intersection of two convex polygons ((n, 2) arrays).
+    """
+    poly_1 = np.asarray(poly_1, dtype=float)
+    poly_2 = np.asarray(poly_2, dtype=float)
+    # Disjoint bounding boxes
+    if (np.any(poly_1.min(axis=0) >= poly_2.max(axis=0)) or
+            np.any(poly_2.min(axis=0) >= poly_1.max(axis=0))):
+        return 0.
+    orientation = np.sign(_signed_polygon_area(poly_2))
+    if orientation == 0:
+        return 0.
+    clipped = _clip_polygon(poly_1, poly_2, orientation)
+    return _polygon_area(clipped) if len(clipped) >= 3 else 0.
+
+
+def _points_in_polygon(points, poly):
+    """
+    Even-odd rule test of points ((n, 2) array) against a polygon
+    ((m, 2) array).
+    """
+    (x, y) = (points[:, None, 0], points[:, None, 1])
+    poly_next = _next_points(poly)
+    (x_a, y_a) = (poly[None, :, 0], poly[None, :, 1])
+    (x_b, y_b) = (poly_next[None, :, 0], poly_next[None, :, 1])
+    straddle = (y_a > y) != (y_b > y)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x_cross = x_a + (y - y_a) * (x_b - x_a) / (y_b - y_a)
+    return np.sum(straddle & (x < x_cross), axis=1) % 2 == 1
+
+
+def _segment_polygon_intersection(p0, p1, poly):
+    """
+    Parameters (t_start, t_end) along each segment p0 -> p1 ((n, 2) arrays)
+    of the first part of the segment lying inside a polygon ((m, 2) array).
+    Both are nan if the segment does not enter the polygon.
+    """
+    d = p1 - p0
+    edges = _next_points(poly) - poly
+    offset = poly[None, :, :] - p0[:, None, :]
+    den = d[:, None, 0] * edges[None, :, 1] - d[:, None, 1] * edges[None, :, 0]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = (offset[..., 0] * edges[None, :, 1] -
+             offset[..., 1] * edges[None, :, 0]) / den
+        u = (offset[..., 0] * d[:, None, 1] -
+             offset[..., 1] * d[:, None, 0]) / den
+    crossing = (den != 0) & (t >= 0) & (t <= 1) & (u >= 0) & (u <= 1)
+    # Segment ends inside the polygon also bound inside parts
+    t = np.column_stack((np.where(_points_in_polygon(p0, poly), 0., np.nan),
+                         np.where(crossing, t, np.nan),
+                         np.where(_points_in_polygon(p1, poly), 1., np.nan)))
+    t = np.sort(t, axis=1)
+    return (t[:, 0], t[:, 1])
+
+
 def _quad_corner_diff(hull_poly, bquad_poly, region_size=0.9):
     """
     Returns the difference between areas in the corners of a rounded
@@ -255,16 +449,11 @@ def _quad_corner_diff(hull_poly, bquad_poly, region_size=0.9):
     region_size (param) determines the region around the corner where
     the comparison is done.
     """
-    bquad_corners = np.zeros((4, 2))
-    bquad_corners[:, 0] = np.asarray(bquad_poly.exterior.coords)[:-1, 0]
-    bquad_corners[:, 1] = np.asarray(bquad_poly.exterior.coords)[:-1, 1]
+    bquad_corners = np.asarray(bquad_poly, dtype=float)
+    center = np.average(bquad_corners, axis=0)
 
     # The point inside the quadrilateral, region_size towards the quad center
-    interior_points = np.zeros((4, 2))
-    interior_points[:, 0] = np.average(bquad_corners[:, 0]) + \
-        region_size * (bquad_corners[:, 0] - np.average(bquad_corners[:, 0]))
-    interior_points[:, 1] = np.average(bquad_corners[:, 1]) + \
-        region_size * (bquad_corners[:, 1] - np.average(bquad_corners[:, 1]))
+    interior_points = center + region_size * (bquad_corners - center)
 
     # The points p0 and p1 (at each corner) define the line whose intersections
     # with the quad together with the corner point define the triangular
@@ -273,41 +462,30 @@ def _quad_corner_diff(hull_poly, bquad_poly, region_size=0.9):
     # The line (out of p0 and p1) is constructed such that it goes through the
     # "interior_point" and is orthogonal to the line going from the corner to
     # the center of the quad.
-    p0_x = interior_points[:, 0] + \
-        (bquad_corners[:, 1] - np.average(bquad_corners[:, 1]))
-    p1_x = interior_points[:, 0] - \
-        (bquad_corners[:, 1] - np.average(bquad_corners[:, 1]))
-    p0_y = interior_points[:, 1] - \
-        (bquad_corners[:, 0] - np.average(bquad_corners[:, 0]))
-    p1_y = interior_points[:, 1] + \
-        (bquad_corners[:, 0] - np.average(bquad_corners[:, 0]))
-
-    corner_area_polys = []
-    for i in range(len(interior_points[:, 0])):
-        bline = LineString([(p0_x[i], p0_y[i]), (p1_x[i], p1_y[i])])
-        corner_area_polys.append(Polygon(
-            [bquad_poly.intersection(bline).coords[0],
-             bquad_poly.intersection(bline).coords[1],
-             (bquad_corners[i, 0], bquad_corners[i, 1])]))
-
-    hull_corner_area = 0
-    quad_corner_area = 0
-    for capoly in corner_area_polys:
-        quad_corner_area += capoly.area
-        if (capoly.intersects(hull_poly)):
-            hull_corner_area += capoly.intersection(hull_poly).area
+    offset = bquad_corners - center
+    p0 = interior_points + np.column_stack((offset[:, 1], -offset[:, 0]))
+    p1 = interior_points - np.column_stack((offset[:, 1], -offset[:, 0]))
+    (t_start, t_end) = _segment_polygon_intersection(p0, p1, bquad_corners)
+    if np.any(np.isnan(t_end)):
+        raise ValueError("Corner line does not cross the quadrilateral")
+    direction = p1 - p0
+    corner_triangles = np.stack((p0 + t_start[:, None] * direction,
+                                 p0 + t_end[:, None] * direction,
+                                 bquad_corners), axis=1)
+
+    quad_corner_area = np.sum(_polygon_area(corner_triangles))
+    hull_corner_area = sum(_convex_intersection_area(hull_poly, triangle)
+                           for triangle in corner_triangles)
 
     return 1. - hull_corner_area / quad_corner_area
 
 
 def _convex_hull_polygon(contour):
     """
-    Returns the convex hull of the given contour as a polygon.
+    Returns the convex hull of the given contour as a polygon ((n, 2) array).
     """
     hull = cv2.convexHull(contour)
-    phull = Polygon([[x, y] for (x, y) in
-                     zip(hull[:, :, 0], hull[:, :, 1])])
-    return phull
+    return hull[:, 0, :].astype(float)
 
 
 def _polygon_form_factor(poly):
@@ -315,10 +493,10 @@ def _polygon_form_factor(poly):
     The ratio between the polygon area and circumference length,
     scaled by the length of the shortest segment.
     """
+    side_lengths = np.sqrt(np.sum((_next_points(poly) - poly) ** 2., axis=1))
     # minimum side length
-    d_0 = np.amin(np.sqrt(np.sum(np.diff(np.asarray(poly.exterior.coords),
-                                         axis=0) ** 2., axis=1)))
-    return poly.area / (poly.length * d_0)
+    d_0 = np.amin(side_lengths)
+    return _polygon_area(poly) / (np.sum(side_lengths) * d_0)
 
 
 def characterize_card_contour(card_contour,
@@ -329,8 +507,46 @@ def characterize_card_contour(card_contour,
     to several charasteristic parameters.
     """
     phull = _convex_hull_polygon(card_contour)
-    if (phull.area < 0.1 * max_segment_area or
-            phull.area < image_area / 1000.):
+    return _characterize_hull(phull, _polygon_area(phull),
+                              max_segment_area, image_area)
+
+
+def characterize_card_contours(card_contours,
+                               max_segment_area,
+                               image_area):
+    """
+    Same as characterize_card_contour for a list of contours, ordered by
+    decreasing area. Contours are explored until the card size range has
+    been explored, the first card candidate setting max_segment_area if
+    it was not set.
+    Contours which cannot be characterized are skipped.
+    Returns a list of (is_card_candidate, bounding_poly, crop_factor), one
+    for each explored contour.
+    """
+    results = []
+    for contour in card_contours:
+        phull = _convex_hull_polygon(contour)
+        area = _polygon_area(phull)
+        try:
+            (continue_segmentation,
+             is_card_candidate,
+             bounding_poly,
+             crop_factor) = _characterize_hull(phull, area,
+                                               max_segment_area, image_area)
+        except (NotImplementedError, ValueError):
+            # Funny contour shapes without a proper bounding quad
+            continue
+        if not continue_segmentation:
+            break
+        if is_card_candidate and max_segment_area < 0.1:
+            max_segment_area = _polygon_area(bounding_poly)
+        results.append((is_card_candidate, bounding_poly, crop_factor))
+    return results
+
+
+def _characterize_hull(phull, hull_area, max_segment_area, image_area):
+    if (hull_area < 0.1 * max_segment_area or
+            hull_area < image_area / 1000.):
         # break after card size range has been explored
         continue_segmentation = False
         is_card_candidate = False
@@ -342,7 +558,7 @@ def characterize_card_contour(card_contour,
         qc_diff = _quad_corner_diff(phull, bounding_poly)
         crop_factor = min(1., (1. - qc_diff * 22. / 100.))
         is_card_candidate = bool(
-            0.1 * max_segment_area < bounding_poly.area <
+            0.1 * max_segment_area < _polygon_area(bounding_poly) <
             image_area * 0.99 and
             qc_diff < 0.35 and
             0.25 < _polygon_form_factor(bounding_poly) < 0.33)
@@ -350,4 +566,18 @@ def characterize_card_contour(card_contour,
     return (continue_segmentation,
             is_card_candidate,
             bounding_poly,
-            crop_factor)
\ No newline at end of file
+            crop_factor)
+
+
+def bounded_map(executor, fn, iterable, max_in_flight):
+    """
+    Lazily maps fn over iterable with the given executor, keeping at most
+    max_in_flight tasks submitted at once. Results are yielded in input order.
+    """
+    pending = deque()
+    for item in iterable:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= max_in_flight:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()